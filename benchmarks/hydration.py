@@ -0,0 +1,57 @@
+"""
+Micro-benchmark of RowSet row hydration.
+
+Rows are fed to RowSet iteration from memory so that only the cost of
+turning result tuples into Table instances is measured. No database is
+needed beyond importing the test models.
+
+    python -m benchmarks.hydration --rows 100000
+"""
+import argparse
+import time
+
+from orm.database import RowSet
+from orm.tests.conftest import TestCompany, TestUser
+
+USER_ROW = ("Lagos, Nigeria", 40, 1, "Charles", "M", "charles")
+COMPANY_ROW = (True, "Catch phrase", 1, "Company", 1)
+
+
+def rows_per_second(row_set, row, count):
+    def sql_read(self, query, params=()):
+        for _ in range(count):
+            yield row
+
+    original_sql_read = RowSet._RowSet__sql_read
+    RowSet._RowSet__sql_read = sql_read
+    try:
+        start = time.perf_counter()
+        for _ in row_set:
+            pass
+        return count / (time.perf_counter() - start)
+    finally:
+        RowSet._RowSet__sql_read = original_sql_read
+
+
+def run(count):
+    return {
+        "user": rows_per_second(TestUser.objects.all(), USER_ROW, count),
+        "company_fk": rows_per_second(TestCompany.objects.all(), COMPANY_ROW, count),
+        "company_join": rows_per_second(
+            TestCompany.objects.filter(owner__age__gte=0),
+            COMPANY_ROW + USER_ROW,
+            count,
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+    for name, rate in run(args.rows).items():
+        print("{:<14} {:>12,.0f} rows/sec".format(name, rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""
+Benchmarks of the ORM hot paths against a PostgreSQL database.
+
+The testuser and testcompany tables are emptied and filled with Faker
+data, so point the DB_* environment variables at a throwaway database.
+
+    python -m benchmarks.suite run --rows 10000 --output results.json
+    python -m benchmarks.suite compare baseline.json results.json
+"""
+import argparse
+import datetime
+import itertools
+import json
+import platform
+import random
+import subprocess
+import sys
+import time
+
+from faker import Faker
+
+from benchmarks import hydration
+from orm.instrumentation import query_stats
+from orm.postgres import PostgreSQL
+from orm.tests.conftest import TestCompany, TestUser
+
+DEFAULT_BULK_SIZES = (1000, 100000, 1000000)
+PROFILE_POOL_SIZE = 1000
+# Metrics where a higher value is better; for the rest lower is better.
+HIGHER_IS_BETTER = ("rows_per_sec",)
+COMPARED_METRICS = ("rows_per_sec", "p50_ms", "p95_ms", "queries")
+
+
+def percentile(values, percent):
+    ordered = sorted(values)
+    return ordered[int(round(percent / 100 * (len(ordered) - 1)))]
+
+
+def summarize(durations, rows, queries):
+    total = sum(durations)
+    return {
+        "ops": len(durations),
+        "rows": rows,
+        "queries": queries,
+        "rows_per_sec": rows / total if total else 0.0,
+        "mean_ms": total / len(durations) * 1000,
+        "p50_ms": percentile(durations, 50) * 1000,
+        "p95_ms": percentile(durations, 95) * 1000,
+        "p99_ms": percentile(durations, 99) * 1000,
+    }
+
+
+def measure(operation, repeat):
+    """
+    Runs `operation` `repeat` times. It returns the number of rows it
+    handled, which is summed into the rows/sec figure.
+    """
+    durations = []
+    rows = 0
+    with query_stats() as stats:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            rows += operation()
+            durations.append(time.perf_counter() - start)
+    return summarize(durations, rows, stats.queries)
+
+
+class Dataset:
+    def __init__(self, seed=0):
+        fake = Faker()
+        Faker.seed(seed)
+        self.profiles = [fake.simple_profile() for _ in range(PROFILE_POOL_SIZE)]
+        self.company_names = [fake.company() for _ in range(PROFILE_POOL_SIZE)]
+        self.catch_phrases = [fake.catch_phrase() for _ in range(PROFILE_POOL_SIZE)]
+        self.year = datetime.date.today().year
+        self.serial = itertools.count()
+
+    def users(self, count):
+        # Profiles are recycled; a serial keeps usernames unique.
+        for profile in itertools.islice(itertools.cycle(self.profiles), count):
+            yield dict(
+                name=profile["name"],
+                username="{}_{}".format(profile["username"], next(self.serial)),
+                sex=profile["sex"],
+                address=profile["address"],
+                age=self.year - profile["birthdate"].year,
+            )
+
+    def companies(self, owner_ids):
+        for i, owner in enumerate(owner_ids):
+            yield dict(
+                owner=owner,
+                name=self.company_names[i % PROFILE_POOL_SIZE],
+                catch_phrase=self.catch_phrases[i % PROFILE_POOL_SIZE],
+                active=bool(i % 2),
+            )
+
+
+def reset_tables():
+    TestUser.migrate()
+    TestCompany.migrate()
+    with PostgreSQL() as pgsql:
+        pgsql.query(
+            "TRUNCATE {}, {} RESTART IDENTITY;".format(
+                TestCompany.get_full_table_name(), TestUser.get_full_table_name()
+            )
+        )
+        pgsql.commit()
+
+
+def bench_bulk_create(dataset, sizes):
+    results = {}
+    for size in sizes:
+        reset_tables()
+        rows = list(dataset.users(size))
+        results["bulk_create_{}".format(size)] = measure(
+            lambda: TestUser.objects.bulk_create(rows), 1
+        )
+    return results
+
+
+def load(dataset, rows):
+    reset_tables()
+    TestUser.objects.bulk_create(dataset.users(rows))
+    user_ids = list(TestUser.objects.values_list("id", flat=True))
+    TestCompany.objects.bulk_create(dataset.companies(user_ids))
+    return user_ids
+
+
+def bench_queries(dataset, rows, repeat):
+    user_ids = load(dataset, rows)
+    random.seed(0)
+    median_age = percentile(TestUser.objects.values_list("age", flat=True), 50)
+    scans = max(1, repeat // 100)
+
+    def get():
+        TestUser.objects.get(id=random.choice(user_ids))
+        return 1
+
+    def filtered_iteration():
+        return sum(1 for _ in TestUser.objects.filter(age__gte=median_age))
+
+    def select_related():
+        return sum(1 for _ in TestCompany.objects.select_related("owner"))
+
+    def count():
+        TestUser.objects.filter(age__gte=median_age).count()
+        return 1
+
+    def save():
+        user = TestUser.objects.get(id=random.choice(user_ids))
+        user.age += 1
+        user.save()
+        return 1
+
+    companies = list(TestCompany.objects.all()[:repeat])
+    fk_lookups = iter(companies)
+
+    def fk_dereference():
+        next(fk_lookups).owner.name
+        return 1
+
+    return {
+        "get": measure(get, repeat),
+        "filtered_iteration": measure(filtered_iteration, scans),
+        "select_related": measure(select_related, scans),
+        "count": measure(count, repeat),
+        "save": measure(save, repeat),
+        "fk_dereference": measure(fk_dereference, len(companies)),
+    }
+
+
+def bench_hydration(rows):
+    return {
+        "hydration_{}".format(name): {"rows_per_sec": rate}
+        for name, rate in hydration.run(rows).items()
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    dataset = Dataset(seed=args.seed)
+    results = {}
+    results.update(bench_bulk_create(dataset, args.bulk_sizes))
+    results.update(bench_queries(dataset, args.rows, args.repeat))
+    results.update(bench_hydration(args.rows))
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "rows": args.rows,
+            "repeat": args.repeat,
+            "bulk_sizes": args.bulk_sizes,
+        },
+        "results": results,
+    }
+    for name, result in results.items():
+        print(format_result(name, result))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+def format_result(name, result):
+    latency = (
+        "  p50 {p50_ms:>8.3f} ms  p95 {p95_ms:>8.3f} ms  p99 {p99_ms:>8.3f} ms".format(
+            **result
+        )
+        if "p50_ms" in result
+        else ""
+    )
+    return "{:<22} {:>12,.0f} rows/sec{}".format(name, result["rows_per_sec"], latency)
+
+
+def compare_results(baseline, current, threshold):
+    """
+    Yields `(case, metric, old, new, change, regressed)` for the metrics both
+    reports share. `change` is the relative difference from the baseline.
+    """
+    for name, result in current["results"].items():
+        old_result = baseline["results"].get(name)
+        if old_result is None:
+            continue
+        for metric in COMPARED_METRICS:
+            old, new = old_result.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = -change if metric in HIGHER_IS_BETTER else change
+            yield name, metric, old, new, change, worse > threshold
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    regressions = 0
+    for name, metric, old, new, change, regressed in compare_results(
+        baseline, current, args.threshold
+    ):
+        regressions += regressed
+        print(
+            "{:<22} {:<13} {:>14,.3f} -> {:>14,.3f} {:>+8.1%}{}".format(
+                name, metric, old, new, change, "  REGRESSION" if regressed else ""
+            )
+        )
+    print(
+        "{} regression(s) beyond {:.0%} against {}".format(
+            regressions, args.threshold, baseline["meta"].get("commit")
+        )
+    )
+    return 1 if regressions else 0
+
+
+def sizes(value):
+    return [int(i) for i in value.split(",") if i]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--rows", type=int, default=10000)
+    run_parser.add_argument("--repeat", type=int, default=1000)
+    run_parser.add_argument(
+        "--bulk-sizes",
+        type=sizes,
+        default=list(DEFAULT_BULK_SIZES),
+        help="comma separated bulk_create sizes",
+    )
+    run_parser.add_argument("--seed", type=int, default=0)
+    run_parser.add_argument("--output", help="write the results to this JSON file")
+    run_parser.set_defaults(handler=run)
+
+    compare_parser = commands.add_parser("compare", help="compare two result files")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="relative change counted as a regression",
+    )
+    compare_parser.set_defaults(handler=compare)
+
+    args = parser.parse_args()
+    sys.exit(args.handler(args))
+
+
+if __name__ == "__main__":
+    main()
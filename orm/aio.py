@@ -0,0 +1,277 @@
+import asyncio
+import time
+import weakref
+from collections import deque
+
+import psycopg2
+from psycopg2 import extensions
+
+from orm import instrumentation
+from orm.postgres import (
+    PoolClosedException,
+    PoolTimeoutException,
+    _pool_settings,
+    get_credentials,
+)
+
+
+async def _wait_fd(add, remove, fd):
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    add(fd, lambda: future.done() or future.set_result(None))
+    try:
+        await future
+    finally:
+        remove(fd)
+
+
+async def wait(conn):
+    """
+    Drives an asynchronous psycopg2 connection until the pending operation
+    completes, yielding to the event loop while the socket is not ready.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == extensions.POLL_OK:
+            return
+        if state == extensions.POLL_READ:
+            await _wait_fd(loop.add_reader, loop.remove_reader, conn.fileno())
+        elif state == extensions.POLL_WRITE:
+            await _wait_fd(loop.add_writer, loop.remove_writer, conn.fileno())
+        else:
+            raise psycopg2.OperationalError("Bad poll state: {}".format(state))
+
+
+class AsyncConnectionPool:
+    """
+    Pool of asynchronous psycopg2 connections for one event loop.
+
+    Connections are opened lazily up to `max_size`. A lease waits for up to
+    `timeout` seconds for a connection to be returned before giving up.
+    """
+
+    def __init__(self, max_size=10, timeout=30.0, credentials=None):
+        if max_size < 1:
+            raise ValueError("Invalid pool size: max_size={}".format(max_size))
+        self.max_size = max_size
+        self.timeout = timeout
+        self._credentials = credentials
+        self._idle = deque()
+        self._size = 0
+        self._closed = False
+        self._condition = asyncio.Condition()
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    async def _connect(self):
+        credentials = self._credentials or get_credentials()
+        try:
+            conn = psycopg2.connect(async_=True, **credentials)
+            await wait(conn)
+            instrumentation.connection_opened()
+            return conn
+        except psycopg2.Error as error:
+            raise ValueError(
+                "Unable to connect to PostgreSQL database\n{error}".format(error=error)
+            )
+
+    def __can_lease(self):
+        return self._closed or self._idle or self._size < self.max_size
+
+    async def getconn(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        async with self._condition:
+            try:
+                await asyncio.wait_for(
+                    self._condition.wait_for(self.__can_lease), timeout
+                )
+            except asyncio.TimeoutError:
+                raise PoolTimeoutException(
+                    "Timed out after {}s waiting for a connection.".format(timeout)
+                )
+            if self._closed:
+                raise PoolClosedException("Connection pool is closed.")
+            while self._idle:
+                conn = self._idle.pop()
+                if not conn.closed:
+                    return conn
+                self._size -= 1
+            self._size += 1
+        try:
+            return await self._connect()
+        except BaseException:
+            async with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    async def putconn(self, conn):
+        if not conn.closed:
+            if conn.isexecuting():
+                # The lease was cancelled mid-query.
+                conn.close()
+            elif conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    with conn.cursor() as cursor:
+                        cursor.execute("ROLLBACK;")
+                        await wait(conn)
+                except psycopg2.Error:
+                    conn.close()
+        async with self._condition:
+            if not self._closed and not conn.closed:
+                self._idle.append(conn)
+            else:
+                conn.close()
+                self._size -= 1
+            self._condition.notify()
+
+    async def closeall(self):
+        async with self._condition:
+            self._closed = True
+            idle, self._idle = self._idle, deque()
+            for conn in idle:
+                conn.close()
+                self._size -= 1
+            self._condition.notify_all()
+
+
+_async_pools = weakref.WeakKeyDictionary()
+
+
+def _async_pool_settings():
+    settings = _pool_settings()
+    return {"max_size": settings["max_size"], "timeout": settings["timeout"]}
+
+
+def get_async_pool():
+    loop = asyncio.get_running_loop()
+    pool = _async_pools.get(loop)
+    if pool is None:
+        pool = _async_pools[loop] = AsyncConnectionPool(**_async_pool_settings())
+    return pool
+
+
+async def configure_async_pool(**kwargs):
+    settings = _async_pool_settings()
+    settings.update(kwargs)
+    loop = asyncio.get_running_loop()
+    old_pool = _async_pools.get(loop)
+    _async_pools[loop] = AsyncConnectionPool(**settings)
+    if old_pool is not None:
+        await old_pool.closeall()
+    return _async_pools[loop]
+
+
+class AsyncPostgreSQL:
+    """
+    Asynchronous counterpart of `orm.postgres.PostgreSQL`. Connections in
+    asynchronous mode autocommit, so a statement is committed on completion
+    unless a transaction is opened with `begin`.
+    """
+
+    def __init__(self, pool=None):
+        self._pool = pool
+        self._conn = None
+        self._cursor = None
+
+    async def __aenter__(self):
+        if self._pool is None:
+            self._pool = get_async_pool()
+        self._conn = await self._pool.getconn()
+        self._cursor = self._conn.cursor()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def close(self):
+        conn = self._conn
+        if conn is None:
+            return
+        self._conn = None
+        if not self._cursor.closed:
+            self._cursor.close()
+        await self._pool.putconn(conn)
+
+    @property
+    def connection(self):
+        return self._conn
+
+    @property
+    def cursor(self):
+        return self._cursor
+
+    async def _execute(self, sql, params=None, logged_sql=None, logged_params=None):
+        if not instrumentation.enabled:
+            self.cursor.execute(sql, params or None)
+            await wait(self.connection)
+            return
+        logged_sql = logged_sql or sql
+        logged_params = logged_params or params
+        instrumentation.before_execute(logged_sql, logged_params)
+        started = time.perf_counter()
+        error = None
+        try:
+            self.cursor.execute(sql, params or None)
+            await wait(self.connection)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            instrumentation.after_execute(
+                logged_sql,
+                logged_params,
+                time.perf_counter() - started,
+                self.cursor.rowcount,
+                error,
+            )
+
+    async def query(self, sql, params=None):
+        await self._execute(sql, params)
+
+    async def begin(self):
+        await self.query("BEGIN;")
+
+    async def commit(self):
+        await self.query("COMMIT;")
+
+    async def rollback(self):
+        await self.query("ROLLBACK;")
+
+    def mogrify(self, sql, params=None):
+        return self.cursor.mogrify(sql, params or ())
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    async def execute_values(self, sql, params, page_size=1000, fetch=False):
+        """
+        Same contract as `psycopg2.extras.execute_values`, which cannot be
+        used on asynchronous connections since it runs pages back to back.
+        """
+        pre, post = [i.encode(self.__encoding()) for i in sql.split("%s", 1)]
+        results = []
+        row_count = 0
+        for start in range(0, len(params), page_size):
+            end = start + page_size
+            page = params[start:end]
+            template = b"(" + b",".join([b"%s"] * len(page[0])) + b")"
+            values = b",".join([self.cursor.mogrify(template, row) for row in page])
+            await self._execute(pre + values + post, logged_sql=sql, logged_params=page)
+            row_count += self.cursor.rowcount
+            if fetch:
+                results += self.fetchall()
+        return results if fetch else row_count
+
+    def __encoding(self):
+        return extensions.encodings[self.connection.encoding]
@@ -0,0 +1,258 @@
+import abc
+import contextvars
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from orm.postgres import get_bound_connection
+
+
+class CacheBackend(abc.ABC):
+    """
+    Storage for cached query results and per-table versions. Results are
+    stored under keys that embed the versions of the tables they were read
+    from, so bumping a version invalidates every result read from that table.
+    """
+
+    @abc.abstractmethod
+    def get(self, key):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set(self, key, value):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def clear(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_version(self, table_name):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def bump_version(self, table_name):
+        raise NotImplementedError
+
+
+class MemoryCacheBackend(CacheBackend):
+    """
+    In-process LRU cache holding at most `maxsize` results and `max_rows`
+    rows in total. Results expire `ttl` seconds after they were stored.
+    """
+
+    def __init__(self, maxsize=1024, max_rows=100000, ttl=None):
+        self.maxsize = maxsize
+        self.max_rows = max_rows
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.rows = 0
+        self._entries = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, size, expires = entry
+                if expires is None or expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self.__remove(key)
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        size = len(value) if isinstance(value, list) else 1
+        if size > self.max_rows:
+            return
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self.__remove(key)
+            self._entries[key] = (value, size, expires)
+            self.rows += size
+            while len(self._entries) > self.maxsize or self.rows > self.max_rows:
+                self.__remove(next(iter(self._entries)))
+
+    def __remove(self, key):
+        self.rows -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.rows = 0
+
+    def get_version(self, table_name):
+        return self._versions.get(table_name, 0)
+
+    def bump_version(self, table_name):
+        with self._lock:
+            self._versions[table_name] = self._versions.get(table_name, 0) + 1
+
+    def info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "rows": self.rows,
+            "maxsize": self.maxsize,
+            "max_rows": self.max_rows,
+        }
+
+
+class SQLiteCacheBackend(CacheBackend):
+    """
+    Cache stored in a SQLite file, shared by every process on the host that
+    opens the same `path`. Least recently read results beyond `maxsize` are
+    evicted.
+    """
+
+    def __init__(self, path, maxsize=1024, ttl=None):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries "
+                "(key TEXT PRIMARY KEY, value BLOB, expires REAL, accessed REAL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS versions "
+                "(name TEXT PRIMARY KEY, version INTEGER NOT NULL)"
+            )
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _hash(key):
+        return hashlib.sha1(pickle.dumps(key)).hexdigest()
+
+    def get(self, key):
+        key = self._hash(key)
+        now = time.time()
+        with self._connection() as conn:
+            row = conn.execute(
+                "SELECT value, expires FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] is not None and row[1] <= now:
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+        return pickle.loads(row[0])
+
+    def set(self, key, value):
+        now = time.time()
+        expires = now + self.ttl if self.ttl is not None else None
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                (self._hash(key), pickle.dumps(value), expires, now),
+            )
+            conn.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries "
+                "ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.maxsize,),
+            )
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM entries")
+
+    def get_version(self, table_name):
+        row = (
+            self._connection()
+            .execute("SELECT version FROM versions WHERE name = ?", (table_name,))
+            .fetchone()
+        )
+        return row[0] if row else 0
+
+    def bump_version(self, table_name):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO versions VALUES (?, 1) "
+                "ON CONFLICT (name) DO UPDATE SET version = version + 1",
+                (table_name,),
+            )
+
+
+def _default_backend():
+    ttl = os.getenv("DB_RESULT_CACHE_TTL")
+    return MemoryCacheBackend(
+        maxsize=int(os.getenv("DB_RESULT_CACHE_SIZE") or 1024),
+        max_rows=int(os.getenv("DB_RESULT_CACHE_MAX_ROWS") or 100000),
+        ttl=float(ttl) if ttl else None,
+    )
+
+
+backend = _default_backend()
+# Tables written inside an atomic block, invalidated again once it ends.
+_pending_invalidations = contextvars.ContextVar("pending_invalidations", default=None)
+
+
+def configure_result_cache(new_backend):
+    global backend
+    backend = new_backend
+    return backend
+
+
+def _freeze(params):
+    return tuple(tuple(i) if isinstance(i, list) else i for i in params)
+
+
+def fetch(sql, params, table_names, fetch_result):
+    """
+    Returns the cached result of `sql` for `params`, calling `fetch_result`
+    on a miss. Reads inside a transaction block bypass the cache since they
+    may see uncommitted writes.
+    """
+    if get_bound_connection() is not None:
+        return fetch_result()
+    cache = backend
+    key = (
+        sql,
+        _freeze(params),
+        tuple([cache.get_version(i) for i in table_names]),
+    )
+    result = cache.get(key)
+    if result is None:
+        result = fetch_result()
+        cache.set(key, result)
+    return result
+
+
+def invalidate(*table_names):
+    cache = backend
+    for name in table_names:
+        cache.bump_version(name)
+    pending = _pending_invalidations.get()
+    if pending is not None:
+        pending.update(table_names)
+
+
+def defer_invalidations():
+    return _pending_invalidations.set(set())
+
+
+def flush_invalidations(token):
+    pending = _pending_invalidations.get()
+    _pending_invalidations.reset(token)
+    if pending:
+        invalidate(*pending)
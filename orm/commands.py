@@ -1,3 +1,5 @@
+import os
+import threading
 from collections import OrderedDict
 
 
@@ -26,6 +28,30 @@ class SQL:
     def insert_table_row():
         return "INSERT INTO {schema}.{table_name} ({column_names}) VALUES ({column_values}) RETURNING id;"
 
+    @staticmethod
+    def insert_table_rows():
+        return (
+            "INSERT INTO {schema}.{table_name} ({column_names}) VALUES %s{returning};"
+        )
+
+    @staticmethod
+    def copy_table_rows():
+        return "COPY {schema}.{table_name} ({column_names}) FROM STDIN WITH (FORMAT {format});"
+
+    @staticmethod
+    def upsert_table_rows():
+        return (
+            "INSERT INTO {schema}.{table_name} ({column_names}) VALUES %s "
+            "ON CONFLICT ({conflict_target}) DO {action};"
+        )
+
+    @staticmethod
+    def update_table_rows():
+        return (
+            "UPDATE {schema}.{table_name} AS t SET {set_key_value} "
+            "FROM (VALUES %s) AS v ({column_names}) WHERE t.{pk} = v.{pk};"
+        )
+
     @staticmethod
     def update_table_row():
         return "UPDATE {schema}.{table_name} SET {set_key_value} WHERE {condition};"
@@ -43,7 +69,75 @@ class SQL:
 LOGICAL_SEPARATOR = "__"
 
 
+class CompiledQueryCache:
+    """
+    LRU cache of compiled SQL keyed on query shape. Only the parameter list
+    is rebuilt when an identical shape is queried again.
+    """
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+        }
+
+
+compiled_query_cache = CompiledQueryCache(
+    maxsize=int(os.getenv("DB_QUERY_CACHE_SIZE") or 512)
+)
+
+
 class Query:
+
+    __operators = {
+        "gt": ">",
+        "gte": ">=",
+        "lt": "<",
+        "lte": "<=",
+        "exact": "=",
+        "iexact": "=",
+        "contains": "LIKE",
+        "icontains": "ILIKE",
+        "startswith": "LIKE",
+        "istartswith": "ILIKE",
+        "endswith": "LIKE",
+        "iendswith": "ILIKE",
+        "isnull": "IS",
+        "in": "=",
+    }
+
     def __init__(
         self,
         schema,
@@ -58,6 +152,13 @@ class Query:
         limit=None,
         offset=None,
         delete=False,
+        count=False,
+        exists=False,
+        values=None,
+        keyset=False,
+        seek=None,
+        aggregates=None,
+        deferred=None,
     ):
         self.__schema = schema
         self.__table_class = table_class
@@ -66,7 +167,7 @@ class Query:
         self.__table_columns = table_columns
         self.__pk = pk
 
-        self.__order_dict = order_dict if order_dict else {"id": "ASC"}
+        self.__order_dict = order_dict if order_dict else {pk or "id": "ASC"}
         self.__filter_dict = filter_dict if filter_dict else {}
         self.__or_filter_dict = or_filter_dict if or_filter_dict else {}
         self.__exclude_dict = exclude_dict if exclude_dict else {}
@@ -75,34 +176,129 @@ class Query:
         self.__limit = limit
         self.__offset = offset
         self.__delete = delete
-        self.__operators = {
-            "gt": ">",
-            "gte": ">=",
-            "lt": "<",
-            "lte": "<=",
-            "exact": "=",
-            "iexact": "=",
-            "contains": "LIKE",
-            "icontains": "ILIKE",
-            "startswith": "LIKE",
-            "istartswith": "ILIKE",
-            "endswith": "LIKE",
-            "iendswith": "ILIKE",
-            "isnull": "IS",
-            "in": "=",
+        self.__count = count
+        self.__exists = exists
+        self.__values = tuple(values) if values else ()
+        self.__keyset = keyset
+        self.__seek = tuple(seek) if seek is not None else None
+        self.__aggregates = tuple(aggregates) if aggregates else ()
+        self.__deferred = tuple(deferred) if deferred else ()
+        self.__sources = {
+            "filter": self.__filter_dict,
+            "or_filter": self.__or_filter_dict,
+            "exclude": self.__exclude_dict,
+            "seek": self.__seek,
         }
-        self.__params = []
-        self.__base_query = "SELECT {};" if not delete else "DELETE {};"
+
+    def __reset_compile_state(self):
+        self.__param_specs = []
+        self.__base_query = self.__get_base_query()
         self.__from_query = ""
         self.__where_query = ""
         self.__order_by_query = ""
         self.__limit_offset_query = ""
         self.__column_query = ""
+        self.__values_columns = []
         self.__proxy_name_count = -1
         self.__base_table_proxy = self.generate_table_name_proxy()
+        self.__proxy_paths = {self.__base_table_proxy: ""}
         self.__join_tables_involved = {}
         self.__table_details = OrderedDict()
 
+    @staticmethod
+    def __list_param(value):
+        if not isinstance(value, list):
+            raise InvalidQueryException("Value should be a list.")
+        return value
+
+    @staticmethod
+    def __contains_param(value):
+        return "%{}%".format(value)
+
+    @staticmethod
+    def __startswith_param(value):
+        return "{}%".format(value)
+
+    @staticmethod
+    def __endswith_param(value):
+        return "%{}".format(value)
+
+    def __add_param(self, source, transform=None):
+        self.__param_specs.append((source, transform))
+
+    def __build_params(self, param_specs):
+        params = []
+        for source, transform in param_specs:
+            if source == "limit":
+                value = self.__limit
+            elif source == "offset":
+                value = self.__offset
+            else:
+                value = self.__sources[source[0]][source[1]]
+            params.append(transform(value) if transform else value)
+        return params
+
+    @staticmethod
+    def __lookup_shape(inputs):
+        return tuple(
+            (k, bool(v)) if k.endswith(LOGICAL_SEPARATOR + "isnull") else k
+            for k, v in inputs.items()
+        )
+
+    def __shape_key(self):
+        return (
+            self.__table_class,
+            self.__schema,
+            tuple(self.__table_columns),
+            self.__pk,
+            self.__lookup_shape(self.__filter_dict),
+            self.__lookup_shape(self.__or_filter_dict),
+            self.__lookup_shape(self.__exclude_dict),
+            frozenset(self.__select_related),
+            tuple(self.__order_dict.items()),
+            self.__limit is not None,
+            bool(self.__offset),
+            self.__delete,
+            self.__count,
+            self.__exists,
+            self.__values,
+            self.__keyset,
+            # NULL keyset values change the seek condition.
+            None if self.__seek is None else tuple([i is None for i in self.__seek]),
+            self.__aggregates,
+            self.__deferred,
+        )
+
+    def __is_sliced(self):
+        return self.__limit is not None or bool(self.__offset)
+
+    def __get_base_query(self):
+        if self.__delete:
+            return "DELETE {};"
+        if self.__count and self.__is_sliced():
+            return "SELECT COUNT(*) FROM (SELECT {}) AS count_query;"
+        if self.__exists:
+            if self.__is_sliced():
+                return "SELECT 1 FROM (SELECT {}) AS exists_query LIMIT 1;"
+            return "SELECT {} LIMIT 1;"
+        return "SELECT {};"
+
+    def __get_select_expression(self, columns):
+        if self.__aggregates:
+            return ", ".join(
+                [
+                    "{}({}.{})".format(function, self.__base_table_proxy, column)
+                    for function, column in self.__aggregates
+                ]
+            )
+        if self.__count and not self.__is_sliced():
+            return "COUNT(*)"
+        if self.__count or self.__exists:
+            return "1"
+        if self.__values:
+            return ", ".join(self.__values_columns)
+        return ", ".join(columns)
+
     def generate_table_name_proxy(self):
         self.__proxy_name_count += 1
         return "table_{}".format(self.__proxy_name_count)
@@ -123,7 +319,7 @@ class Query:
                 "base_table_name": "{}".format(base_table_class.get_full_table_name()),
                 "key": key,
                 "fk_table_pk": fk_table_class.get_pk_name(),
-                "fk_columns": fk_table_class.get_column_names(),
+                "fk_columns": fk_table_class._meta.column_names,
                 "fk_table_class": fk_table_class,
                 "base_table_class": base_table_class,
             },
@@ -137,34 +333,38 @@ class Query:
             return self.__join_tables_involved[fk_details_key]
         else:
             proxy = self.generate_table_name_proxy()
+            parent_path = self.__proxy_paths[last_proxy]
+            self.__proxy_paths[proxy] = (
+                parent_path + LOGICAL_SEPARATOR + key if parent_path else key
+            )
             self.__table_details[proxy] = join_data
             self.__join_tables_involved[fk_details_key] = proxy
             return proxy
 
-    def __logical_conditions(self, key, value, condition, table_proxy_name=None):
+    def __logical_conditions(
+        self, key, value, condition, source, table_proxy_name=None
+    ):
         if not table_proxy_name:
             table_proxy_name = self.__base_table_proxy
         if key == "pk":
             key = self.__pk
         key = "{}.{}".format(table_proxy_name, key)
         if condition == "=":
-            self.__params.append(value)
+            self.__add_param(source)
             return "{key}=%s".format(key=key)
         if condition == "in":
-            if isinstance(value, list):
-                self.__params.append(value)
-                return "{key} {operation} ANY(%s)".format(
-                    key=key, operation=self.__operators[condition]
-                )
-            else:
-                raise InvalidQueryException("Value should be a list.")
+            self.__list_param(value)
+            self.__add_param(source, self.__list_param)
+            return "{key} {operation} ANY(%s)".format(
+                key=key, operation=self.__operators[condition]
+            )
         if condition == "isnull":
             base = "{key} {operation}".format(
                 key=key, operation=self.__operators[condition]
             )
             return "{} NULL".format(base) if value else "{} NOT NULL".format(base)
         if condition == "iexact":
-            self.__params.append(value)
+            self.__add_param(source)
             return "LOWER({key}){operation}LOWER(%s)".format(
                 key=key,
                 operation=self.__operators[condition],
@@ -178,26 +378,27 @@ class Query:
             "iendswith",
         ):
             if condition == "contains" or condition == "icontains":
-                self.__params.append("%{}%".format(value))
+                self.__add_param(source, self.__contains_param)
             elif condition == "startswith" or condition == "istartswith":
-                self.__params.append("{}%".format(value))
+                self.__add_param(source, self.__startswith_param)
             elif condition == "endswith" or condition == "iendswith":
-                self.__params.append("%{}".format(value))
+                self.__add_param(source, self.__endswith_param)
             return "{key} {operation} %s".format(
                 key=key,
                 operation=self.__operators[condition],
             )
-        self.__params.append(value)
+        self.__add_param(source)
         return "{key}{operation}%s".format(
             key=key,
             operation=self.__operators[condition],
         )
 
-    def __change_to_sql_conditions(self, key, value):
+    def __change_to_sql_conditions(self, key, value, source_name):
+        source = (source_name, key)
         key_splits = key.split(LOGICAL_SEPARATOR)
         if len(key_splits) == 1:
             return self.__logical_conditions(
-                key=key_splits[0], value=value, condition="="
+                key=key_splits[0], value=value, condition="=", source=source
             )
         else:
             proxy = None
@@ -207,7 +408,7 @@ class Query:
                 fk_fields = key_splits[:-2]
                 if not fk_fields:
                     return self.__logical_conditions(
-                        key=key, value=value, condition=condition
+                        key=key, value=value, condition=condition, source=source
                     )
             else:
                 key = key_splits[-1]
@@ -217,7 +418,7 @@ class Query:
             if fk_fields:
                 table_class = self.__table_class
                 for fk in fk_fields:
-                    fk_table_class = getattr(table_class.__dict__[fk], "table_name")
+                    fk_table_class = table_class._meta.fk_targets[fk]
                     proxy = self.__update_join_tables_involved(
                         base_table_class=table_class,
                         fk_table_class=fk_table_class,
@@ -227,7 +428,11 @@ class Query:
                     table_class = fk_table_class
 
             return self.__logical_conditions(
-                key=key, value=value, condition=condition, table_proxy_name=proxy
+                key=key,
+                value=value,
+                condition=condition,
+                source=source,
+                table_proxy_name=proxy,
             )
 
     def __create_where_query(self):
@@ -236,7 +441,7 @@ class Query:
             filter_query = "( {} )".format(
                 " OR ".join(
                     [
-                        self.__change_to_sql_conditions(k, v)
+                        self.__change_to_sql_conditions(k, v, "or_filter")
                         for k, v in self.__or_filter_dict.items()
                     ]
                 )
@@ -246,7 +451,7 @@ class Query:
                 filter_query += " AND "
             filter_query += " AND ".join(
                 [
-                    self.__change_to_sql_conditions(k, v)
+                    self.__change_to_sql_conditions(k, v, "filter")
                     for k, v in self.__filter_dict.items()
                 ]
             )
@@ -256,20 +461,79 @@ class Query:
             filter_query += "NOT "
             filter_query += " AND NOT ".join(
                 [
-                    self.__change_to_sql_conditions(k, v)
+                    self.__change_to_sql_conditions(k, v, "exclude")
                     for k, v in self.__exclude_dict.items()
                 ]
             )
+        if self.__seek is not None:
+            if filter_query:
+                filter_query += " AND "
+            filter_query += self.__create_seek_condition()
         if filter_query:
             filter_query = " WHERE {}".format(filter_query)
         self.__where_query = filter_query
 
+    def __get_order_items(self):
+        items = list(self.__order_dict.items())
+        if self.__keyset and self.__pk not in self.__order_dict:
+            # The pk breaks ties so that every row has a unique position.
+            items.append((self.__pk, items[-1][1] if items else "ASC"))
+        return items
+
+    def __is_nullable(self, column):
+        field = self.__table_class._meta.fields.get(column)
+        return field is not None and field.null
+
+    def __seek_after(self, i, column, direction, nullable):
+        # NULLs sort last ascending and first descending, as in ORDER BY.
+        if self.__seek[i] is None:
+            return "{} IS NOT NULL".format(column)
+        self.__add_param(("seek", i))
+        if direction == "ASC":
+            if nullable:
+                return "({0}>%s OR {0} IS NULL)".format(column)
+            return "{}>%s".format(column)
+        return "{}<%s".format(column)
+
+    def __create_seek_condition(self):
+        items = self.__get_order_items()
+        if len(items) != len(self.__seek):
+            raise InvalidQueryException(
+                "Expected {} keyset values, got {}.".format(
+                    len(items), len(self.__seek)
+                )
+            )
+        columns = ["{}.{}".format(self.__base_table_proxy, k) for k, _ in items]
+        nullable = [self.__is_nullable(k) for k, _ in items]
+        operators = [">" if v == "ASC" else "<" for _, v in items]
+        if len(set(operators)) == 1 and not any(nullable) and None not in self.__seek:
+            for i in range(len(items)):
+                self.__add_param(("seek", i))
+            return "({}) {} ({})".format(
+                ", ".join(columns), operators[0], ", ".join(["%s"] * len(columns))
+            )
+        conditions = []
+        for i, column in enumerate(columns):
+            if self.__seek[i] is None and items[i][1] == "ASC":
+                # Nothing sorts after a NULL in ascending order.
+                continue
+            condition = []
+            for j in range(i):
+                if self.__seek[j] is None:
+                    condition.append("{} IS NULL".format(columns[j]))
+                else:
+                    self.__add_param(("seek", j))
+                    condition.append("{}=%s".format(columns[j]))
+            condition.append(self.__seek_after(i, column, items[i][1], nullable[i]))
+            conditions.append("({})".format(" AND ".join(condition)))
+        return "({})".format(" OR ".join(conditions))
+
     def __process_select_related(self):
         for fk_item in set(self.__select_related):
             proxy = None
             parent_class = self.__table_class
             for fk in fk_item.split("__"):
-                fk_table_class = getattr(parent_class.__dict__[fk], "table_name")
+                fk_table_class = parent_class._meta.fk_targets[fk]
                 proxy = self.__update_join_tables_involved(
                     base_table_class=parent_class,
                     fk_table_class=fk_table_class,
@@ -279,6 +543,29 @@ class Query:
                 )
                 parent_class = fk_table_class
 
+    def __process_values(self):
+        for value in self.__values:
+            proxy = self.__base_table_proxy
+            parent_class = self.__table_class
+            *fk_fields, column = value.split(LOGICAL_SEPARATOR)
+            for fk in fk_fields:
+                fk_table_class = parent_class._meta.fk_targets[fk]
+                proxy = self.__update_join_tables_involved(
+                    base_table_class=parent_class,
+                    fk_table_class=fk_table_class,
+                    key=fk,
+                    last_proxy=proxy,
+                    avoid_duplicates=True,
+                )
+                parent_class = fk_table_class
+            if column == "pk":
+                column = parent_class.get_pk_name()
+            self.__values_columns.append("{}.{}".format(proxy, column))
+
+    def __selected_columns(self, proxy, columns):
+        deferred = dict(self.__deferred).get(self.__proxy_paths[proxy], ())
+        return ["{}.{}".format(proxy, i) for i in columns if i not in deferred]
+
     def __switch_to_join_query(self):
         if self.__delete:
             from_query = "FROM {} AS {} USING ".format(
@@ -292,16 +579,14 @@ class Query:
             self.__from_query = from_query + ", ".join(fk_tables)
         else:
             join_query = ""
-            columns = [
-                "{}.{}".format(self.__base_table_proxy, i)
-                for i in self.__table_class.get_column_names()
-            ]
+            columns = self.__selected_columns(
+                self.__base_table_proxy, self.__table_columns
+            )
 
             for proxy_name, table_details in self.__table_details.items():
-                columns += [
-                    "{}.{}".format(proxy_name, j)
-                    for j in table_details["details"]["fk_columns"]
-                ]
+                columns += self.__selected_columns(
+                    proxy_name, table_details["details"]["fk_columns"]
+                )
 
                 fk_table = "{} AS {}".format(
                     table_details["details"]["fk_table_name"], proxy_name
@@ -314,7 +599,7 @@ class Query:
                 )
                 join_query += " LEFT JOIN " + fk_table + " ON " + on_join
 
-            self.__column_query = ", ".join(columns)
+            self.__column_query = self.__get_select_expression(columns)
             self.__from_query = "{} FROM {} AS {}{}".format(
                 self.__column_query,
                 self.__full_table_name,
@@ -332,8 +617,8 @@ class Query:
                     self.__full_table_name, proxy_name
                 )
             else:
-                self.__column_query = ", ".join(
-                    ["{}.{}".format(proxy_name, i) for i in self.__table_columns]
+                self.__column_query = self.__get_select_expression(
+                    self.__selected_columns(proxy_name, self.__table_columns)
                 )
                 self.__from_query = "{} FROM {}".format(
                     self.__column_query,
@@ -342,32 +627,72 @@ class Query:
 
     def __create_order_by_query(self):
         order_query = ""
-        if not self.__delete:
-            if self.__order_dict:
+        skip_ordering = (
+            self.__delete
+            or self.__aggregates
+            or ((self.__count or self.__exists) and not self.__is_sliced())
+        )
+        if not skip_ordering:
+            order_items = self.__get_order_items()
+            if order_items:
                 order_query = ", ".join(
                     [
-                        "{}.{} {}".format(self.__base_table_proxy, k, v)
-                        for k, v in self.__order_dict.items()
+                        "{}.{} {}{}".format(
+                            self.__base_table_proxy,
+                            k,
+                            v,
+                            self.__get_nulls_order(k, v),
+                        )
+                        for k, v in order_items
                     ]
                 )
             if order_query:
                 order_query = " ORDER BY {}".format(order_query)
         self.__order_by_query = order_query
 
+    def __get_nulls_order(self, column, direction):
+        # Spelled out for keyset pages, whose seek condition relies on it.
+        if not (self.__keyset and self.__is_nullable(column)):
+            return ""
+        return " NULLS LAST" if direction == "ASC" else " NULLS FIRST"
+
     def __create_limit_offset_query(self):
         query = ""
         if self.__limit is not None:
-            query += " LIMIT {}".format(self.__limit)
+            self.__add_param("limit")
+            query += " LIMIT %s"
         if self.__offset:
-            query += " OFFSET {}".format(self.__offset)
+            self.__add_param("offset")
+            query += " OFFSET %s"
         self.__limit_offset_query = query
 
     def query(self):
+        key = self.__shape_key()
+        compiled = compiled_query_cache.get(key)
+        if compiled is None:
+            compiled = self.__compile()
+            compiled_query_cache.set(key, compiled)
+        sql, param_specs, column_query, table_details, base_table_proxy = compiled
+        return (
+            sql,
+            self.__build_params(param_specs),
+            column_query,
+            table_details,
+            base_table_proxy,
+        )
+
+    def __compile(self):
+        if self.__aggregates and self.__is_sliced():
+            raise InvalidQueryException("Aggregates cannot be used on a sliced query.")
+        self.__reset_compile_state()
 
         # NOTE: Needs discussion or investigation -@charles-PC at 5/7/2022, 7:04:29 PM
         # Following stand SQL statements SELECT / DELETE, FROM, WHERE, ORDER BY, LIMIT etc ...
         self.__create_where_query()
-        self.__process_select_related()
+        if self.__values:
+            self.__process_values()
+        elif not (self.__count or self.__exists or self.__aggregates):
+            self.__process_select_related()
         self.__create_from_query()
 
         self.__create_order_by_query()
@@ -382,7 +707,7 @@ class Query:
 
         return (
             self.__base_query.format(query),
-            self.__params,
+            self.__param_specs,
             self.__column_query,
             self.__table_details,
             self.__base_table_proxy,
@@ -1,10 +1,23 @@
-import inspect
-from collections import OrderedDict
-from copy import deepcopy
-
+import copy
+import itertools
+import os
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache, partial
+
+from orm import cache, identity, instrumentation, transaction
+from orm.aio import AsyncPostgreSQL
 from orm.commands import LOGICAL_SEPARATOR, SQL, Query
 from orm.fields import BaseField, ForeignKeyField
-from orm.postgres import PostgreSQL
+from orm.postgres import (
+    ITERATOR_CHUNK_SIZE,
+    PostgreSQL,
+    bind_connection,
+    copy_binary_rows,
+    copy_text_rows,
+    get_bound_connection,
+)
 
 
 class SQLException(Exception):
@@ -26,11 +39,298 @@ class MultipleObjectsFound(Exception):
     pass
 
 
+class TableOptions:
+    """
+    Column metadata of a `Table` subclass, compiled once when the class is
+    defined so that queries and row hydration never touch the catalog.
+    """
+
+    def __init__(self, table_class):
+        fields = {}
+        for k, v in table_class.__dict__.items():
+            if isinstance(v, BaseField):
+                if k != k.lower():
+                    raise SQLException("Column names should be in lowercase.")
+                fields[k] = v
+        self.table_name = table_class.__name__.lower()
+        self.column_names = tuple(sorted(fields))
+        self.fields = {k: fields[k] for k in self.column_names}
+        self.pk_name = next((k for k, v in self.fields.items() if v.primary_key), None)
+        self.non_pk_columns = tuple(k for k in self.column_names if k != self.pk_name)
+        self.fk_targets = {
+            k: v.table_name
+            for k, v in self.fields.items()
+            if isinstance(v, ForeignKeyField)
+        }
+        self.quoted_columns = {k: '"{}"'.format(k) for k in self.column_names}
+        self.model = table_class
+        self.meta_field = table_class.__dict__.get("Meta")
+        self.compact = getattr(self.meta_field, "compact", False)
+        self.cache = getattr(self.meta_field, "cache", False)
+        self.compact_class = None
+
+
+class TableMeta(type):
+    def __new__(mcs, name, bases, namespace):
+        cls = super().__new__(mcs, name, bases, namespace)
+        if "_meta" not in namespace:
+            cls._meta = TableOptions(cls)
+        return cls
+
+
+def _rebuild_compact_row(table_class, values, loaded_values):
+    obj = table_class.compact_class()._from_db(table_class._meta.column_names, values)
+    obj._loaded_values = loaded_values
+    return obj
+
+
+class CompactRow:
+    """
+    Mixin of the `__slots__` based row classes built by
+    `Table.compact_class()`. Column values live in slots instead of a
+    per-instance dict and attribute access skips `Table.__getattribute__`.
+    """
+
+    __slots__ = ()
+    __getattribute__ = object.__getattribute__
+    __setattr__ = object.__setattr__
+
+    def __init__(self, **kwargs):
+        for i in self._meta.column_names:
+            setattr(self, i, kwargs.get(i))
+        self._loaded_values = None
+
+    def __getattr__(self, item):
+        # Only reached for unset slots, i.e deferred columns.
+        if item in self._meta.fields:
+            return _load_deferred(self, item)
+        raise AttributeError(
+            "'{}' object has no attribute '{}'".format(type(self).__name__, item)
+        )
+
+    def _is_loaded(self, column_name):
+        try:
+            object.__getattribute__(self, column_name)
+        except AttributeError:
+            return False
+        return True
+
+    def __reduce__(self):
+        meta = self._meta
+        return (
+            _rebuild_compact_row,
+            (
+                meta.model,
+                tuple([getattr(self, i) for i in meta.column_names]),
+                self._loaded_values,
+            ),
+        )
+
+    @classmethod
+    def _from_db(cls, column_names, values, raw_values=None):
+        obj = cls.__new__(cls)
+        for name, value in zip(column_names, values):
+            setattr(obj, name, value)
+        obj._loaded_values = (
+            column_names,
+            values if raw_values is None else raw_values,
+        )
+        return obj
+
+
+def _identity_mapped(hydrate, model, pk_index):
+    def hydrate_mapped(row):
+        objects = identity.get_identity_map()
+        if objects is None:
+            return hydrate(row)
+        obj = objects.get(model, row[pk_index])
+        if obj is None:
+            obj = objects.add(hydrate(row))
+        return obj
+
+    return hydrate_mapped
+
+
+@lru_cache(maxsize=512)
+def get_hydrator(table_class, base_table_proxy, column_query, joins, mapped=False):
+    """
+    Build a function turning one result row into a model instance. The
+    column positions of every table proxy and the nesting of joined tables
+    are resolved here, once per compiled query, so that hydrating a row
+    costs a few slices and attribute stores. With `mapped`, rows whose
+    instance is already in the active identity map are not hydrated again.
+    """
+    proxy_columns = {}
+    for index, label in enumerate(column_query.split(",")):
+        proxy, column = label.strip().split(".")
+        proxy_columns.setdefault(proxy, []).append((index, column))
+    proxy_classes = {base_table_proxy: table_class}
+    child_proxies = {}
+    for proxy, parent_proxy, key, fk_table_class in joins:
+        proxy_classes[proxy] = fk_table_class
+        child_proxies.setdefault((parent_proxy, key), proxy)
+
+    def build(proxy):
+        proxy_class = proxy_classes[proxy]
+        meta = proxy_class._meta
+        columns = proxy_columns.get(proxy, [])
+        indexes = [i for i, _ in columns]
+        names = tuple([c for _, c in columns])
+        if indexes == list(range(indexes[0], indexes[-1] + 1)):
+            row_slice = slice(indexes[0], indexes[-1] + 1)
+        else:
+            row_slice = None
+
+        nested = []
+        bound = []
+        for column in meta.fk_targets:
+            if column not in names:
+                continue
+            position = names.index(column)
+            if (proxy, column) in child_proxies:
+                nested.append(
+                    (
+                        position,
+                        meta.fields[column],
+                        build(child_proxies[(proxy, column)]),
+                    )
+                )
+            else:
+                bound.append((position, meta.fields[column]))
+        if meta.compact:
+            proxy_class = proxy_class.compact_class()
+        from_db = proxy_class._from_db
+
+        if not nested and not bound and row_slice is not None:
+
+            def hydrate(row):
+                return from_db(names, row[row_slice])
+
+        else:
+
+            def hydrate(row):
+                if row_slice is not None:
+                    raw_values = row[row_slice]
+                else:
+                    raw_values = tuple([row[i] for i in indexes])
+                values = list(raw_values)
+                for position, field, hydrate_related in nested:
+                    if values[position] is None:
+                        values[position] = field.bind(None)
+                    else:
+                        values[position] = hydrate_related(row)
+                for position, field in bound:
+                    values[position] = field.bind(values[position])
+                return from_db(names, values, raw_values)
+
+        if mapped and meta.pk_name in names:
+            return _identity_mapped(
+                hydrate, meta.model, indexes[names.index(meta.pk_name)]
+            )
+        return hydrate
+
+    return build(base_table_proxy)
+
+
+def prefetch_related_objects(instances, table_class, path):
+    """
+    Load the objects referenced along `path` (i.e `owner__employer`) for all
+    `instances` with one `pk = ANY(...)` query per hop and attach them in
+    place of the lazily loaded foreign key fields.
+    """
+    for fk in path.split(LOGICAL_SEPARATOR):
+        fk_table_class = table_class._meta.fk_targets[fk]
+        related = {}
+        pending = {}
+        for obj in instances:
+            value = getattr(obj, fk)
+            if isinstance(value, Table):
+                related[value.pk] = value
+                continue
+            pk = Table.get_value_or_object_pk(value)
+            if pk is not None:
+                pending.setdefault(pk, []).append(obj)
+        if pending:
+            for related_obj in fk_table_class.objects.filter(pk__in=list(pending)):
+                related[related_obj.pk] = related_obj
+                for obj in pending[related_obj.pk]:
+                    setattr(obj, fk, related_obj)
+        instances = list(related.values())
+        table_class = fk_table_class
+
+
+class DeferredColumns:
+    """
+    The deferred columns of a batch of `table_class` instances, loaded for
+    the whole batch with one query the first time one of them is read.
+    """
+
+    def __init__(self, table_class, column_names, instances):
+        self.table_class = table_class
+        self.column_names = column_names
+        self.instances = instances
+
+    def load(self):
+        meta = self.table_class._meta
+        pending = {}
+        for obj in self.instances:
+            missing = [i for i in self.column_names if not obj._is_loaded(i)]
+            if missing:
+                pending.setdefault(obj.pk, []).append((obj, missing))
+        if not pending:
+            return
+        rows = self.table_class.objects.filter(pk__in=list(pending)).values_list(
+            meta.pk_name, *self.column_names
+        )
+        for row in rows:
+            values = dict(zip(self.column_names, row[1:]))
+            for obj, missing in pending[row[0]]:
+                for i in missing:
+                    field = meta.fields[i]
+                    value = values[i]
+                    if isinstance(field, ForeignKeyField):
+                        value = field.bind(value)
+                    setattr(obj, i, value)
+                names, raw_values = obj._loaded_values
+                obj._loaded_values = (
+                    names + tuple(missing),
+                    tuple(raw_values) + tuple([values[i] for i in missing]),
+                )
+                obj._deferred = None
+
+
+def _load_deferred(obj, column_name):
+    deferred = getattr(obj, "_deferred", None)
+    if deferred is not None:
+        deferred.load()
+    if not obj._is_loaded(column_name):
+        raise ObjectDoesNotExist(
+            "Deferred column {} could not be loaded.".format(column_name)
+        )
+    return getattr(obj, column_name)
+
+
+@lru_cache(maxsize=512)
+def get_named_row_class(field_names):
+    return namedtuple("Row", field_names)
+
+
+def _scan_partition(row_set, chunk_size, fn=list):
+    # A forked worker must never reuse a connection bound in the parent.
+    bind_connection(None)
+    return fn(row_set.iterator(chunk_size=chunk_size))
+
+
 class RowSet:
+
+    default_chunk_size = ITERATOR_CHUNK_SIZE
+    prefetch_chunk_size = 100
+    copy_batch_size = 10000
+    insert_batch_size = 1000
+
     def __init__(self, table_class):
-        self.pgsql = PostgreSQL()
         self.__table_class = table_class
-        self.__table_columns = table_class.get_column_names()
+        self.__table_columns = table_class._meta.column_names
         self.__filter_exclude_inputs = {
             "filter": {},
             "or_filter": {},
@@ -41,10 +341,17 @@ class RowSet:
         self.__offset = None
         self.__delete = False
         self.__select_related = []
-        self.__columns_order = []
-        self.__value = None
-        self.__table_details = None
-        self.__base_table_proxy = None
+        self.__prefetch_related = []
+        self.__result_cache = None
+        self.__hydrate = None
+        self.__values_fields = ()
+        self.__values_mode = None
+        self.__keyset = False
+        self.__seek = None
+        self.__query_tables = ()
+        self.__only = ()
+        self.__deferred = ()
+        self.__query_deferred = ()
 
     @staticmethod
     def get_details_from_table_proxy(proxy):
@@ -56,26 +363,51 @@ class RowSet:
     def __exit__(self, exc_type, exc_value, traceback):
         self.close()
 
-    def __del__(self):
-        self.close()
-
     def close(self):
-        self.pgsql.close()
+        # Connections are leased from the pool per statement, so a RowSet
+        # holds nothing that needs releasing.
+        pass
 
     def __sql_read(self, query, params=()):
-        for i in self.pgsql.fetch_query_results(query, params=params):
-            yield i
+        with PostgreSQL() as pgsql:
+            for i in pgsql.fetch_query_results(query, params=params, prepare=True):
+                yield i
+
+    def __sql_row(self, query, params=()):
+        with PostgreSQL() as pgsql:
+            pgsql.query(query, params=params, prepare=True)
+            return pgsql.fetchone()
+
+    def __sql_scalar(self, query, params=()):
+        row = self.__sql_row(query, params)
+        return row[0] if row else None
 
     def __sql_delete(self, query, params=()):
-        self.pgsql.query(query, params=params)
-        self.pgsql.commit()
+        with PostgreSQL() as pgsql:
+            pgsql.query(query, params=params)
+            pgsql.commit()
+        self.__invalidate_cache()
+
+    def __cached(self, query, fetch_result):
+        if not self.__table_class._meta.cache:
+            return fetch_result()
+        return cache.fetch(
+            query["query"], query["params"], self.__query_tables, fetch_result
+        )
+
+    def __invalidate_cache(self):
+        cache.invalidate(self.__table_class.get_full_table_name())
 
     def __update_query_inputs(self, data):
         if data:
             for k, v in data.items():
                 self.__filter_exclude_inputs[k].update(v)
 
-    def __create_query(self):
+    def __create_query(self, count=False, exists=False, aggregates=None):
+        hydrated = not (
+            count or exists or aggregates or self.__delete or self.__values_mode
+        )
+        self.__query_deferred = self.__get_deferred_columns() if hydrated else ()
         query = Query(
             schema=self.__table_class.get_schema(),
             table_class=self.__table_class,
@@ -89,78 +421,91 @@ class RowSet:
             limit=self.__limit,
             offset=self.__offset,
             delete=self.__delete,
+            count=count,
+            exists=exists,
+            values=self.__values_fields,
+            keyset=self.__keyset,
+            seek=self.__seek,
+            aggregates=aggregates,
+            deferred=self.__query_deferred,
         )
         (
             sql_query,
             params,
             column_query,
-            self.__table_details,
-            self.__base_table_proxy,
+            table_details,
+            base_table_proxy,
         ) = query.query()
-        self.__columns_order = [i.strip().strip('n"') for i in column_query.split(",")]
+        self.__query_tables = (self.__table_class.get_full_table_name(),) + tuple(
+            [
+                details["details"]["fk_table_class"].get_full_table_name()
+                for details in table_details.values()
+            ]
+        )
+        if self.__values_mode:
+            self.__hydrate = self.__get_values_converter()
+        elif hydrated:
+            self.__hydrate = get_hydrator(
+                self.__table_class,
+                base_table_proxy,
+                column_query,
+                tuple(
+                    [
+                        (
+                            proxy,
+                            details["parent_proxy"],
+                            details["details"]["key"],
+                            details["details"]["fk_table_class"],
+                        )
+                        for proxy, details in table_details.items()
+                    ]
+                ),
+                identity.get_identity_map() is not None,
+            )
 
         return {"query": sql_query, "params": params}
 
-    def __set_attributes(self, column_values):
-
-        data_map = {}
-        used_proxies = []
-        for i in range(len(column_values)):
-            p, c = self.__columns_order[i].split(".")
-            if p not in data_map:
-                data_map[p] = {}
-            data_map[p][c] = column_values[i]
-        data_map = OrderedDict(
-            sorted([(k, v) for k, v in data_map.items()], key=lambda x: x[0])
+    def __get_values_converter(self):
+        fields = self.__values_fields
+        if self.__values_mode == "dict":
+            return lambda row: dict(zip(fields, row))
+        if self.__values_mode == "flat":
+            return lambda row: row[0]
+        if self.__values_mode == "named":
+            return get_named_row_class(fields)._make
+        return tuple
+
+    def __set_values(self, fields, mode):
+        clone = self.__clone()
+        fields = fields or self.__table_columns
+        for field in fields:
+            table_class = self.__table_class
+            *fk_fields, column = field.split(LOGICAL_SEPARATOR)
+            for fk in fk_fields:
+                if fk not in table_class._meta.fk_targets:
+                    raise QueryException("Foreign key not found: {}".format(field))
+                table_class = table_class._meta.fk_targets[fk]
+            if column != "pk" and column not in table_class._meta.column_names:
+                raise QueryException("Column not found: {}".format(field))
+        clone.__values_fields = tuple(fields)
+        clone.__values_mode = mode
+        return clone
+
+    def values(self, *fields):
+        return self.__set_values(fields, "dict")
+
+    def values_list(self, *fields, flat=False, named=False):
+        if flat and named:
+            raise QueryException("flat and named cannot be used together.")
+        if flat and len(fields) != 1:
+            raise QueryException("flat requires exactly one field.")
+        return self.__set_values(
+            fields, "flat" if flat else "named" if named else "tuple"
         )
 
-        def get_table_proxy(tbl_class, base_tbl_class, f_key):
-
-            for proxy_k, proxy_v in self.__table_details.items():
-                conditions = (
-                    proxy_v["details"]["fk_table_class"] == tbl_class
-                    and proxy_v["details"]["base_table_class"] == base_tbl_class
-                    and proxy_v["details"]["key"] == f_key
-                )
-                if conditions and proxy_k not in used_proxies:
-                    used_proxies.append(proxy_k)
-                    return proxy_k
-            return
-
-        def fill_table_attributes(proxy_name):
-
-            if proxy_name == self.__base_table_proxy:
-                table_class = self.__table_class
-            else:
-                table_class = self.__table_details[proxy_name]["details"][
-                    "fk_table_class"
-                ]
-            obj = table_class()
-            for column in table_class.get_column_names():
-                if isinstance(table_class.__dict__[column], ForeignKeyField):
-                    obj_fk_table_class = getattr(
-                        table_class.__dict__[column], "table_name"
-                    )
-                    fk_proxy = get_table_proxy(
-                        tbl_class=obj_fk_table_class,
-                        base_tbl_class=table_class,
-                        f_key=column,
-                    )
-                    if fk_proxy:
-                        setattr(obj, column, fill_table_attributes(fk_proxy))
-                    else:
-                        obj_f_key = deepcopy(table_class.__dict__[column])
-                        obj_f_key.set_value(data_map[proxy_name][column])
-                        setattr(obj, column, obj_f_key)
-                else:
-                    setattr(obj, column, data_map[proxy_name][column])
-            return obj
-
-        main_obj = fill_table_attributes(proxy_name=self.__base_table_proxy)
-        return main_obj
-
     def __getitem__(self, index):
-
+        if self.__result_cache is not None:
+            return self.__result_cache[index]
         if isinstance(index, slice):
             if index.step:
                 print(
@@ -169,7 +514,8 @@ class RowSet:
             start = int(index.start) if index.start else 0
             if start < 0:
                 raise ValueError("Start index cannot be negative.")
-            self.__offset = start
+            clone = self.__clone()
+            clone.__offset = start
 
             stop = int(index.stop) if index.stop else None
             if stop:
@@ -177,29 +523,242 @@ class RowSet:
                     raise ValueError(
                         "Stop index cannot be negative and less than Start index."
                     )
-                self.__limit = stop - start
-            return self.__iter__()
+                clone.__limit = stop - start
+            return clone
         if isinstance(index, int):
             if index < 0:
                 raise ValueError("Index cannot be negative.")
-            self.__limit = 1
-            self.__offset = index
-            return [i for i in self.__iter__()][0]
+            clone = self.__clone()
+            clone.__limit = 1
+            clone.__offset = index
+            return clone.__fetch_all()[0]
         raise ValueError("Invalid index.")
 
-    def __iter__(self):
-        if self.__value is None:
-            for i in self.__sql_read(**self.__create_query()):
-                obj = self.__set_attributes(i)
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Hydrators are cached closures; they are rebuilt on the next query.
+        state["_RowSet__hydrate"] = None
+        return state
+
+    def __clone(self):
+        clone = copy.copy(self)
+        clone.__filter_exclude_inputs = {
+            k: v.copy() for k, v in self.__filter_exclude_inputs.items()
+        }
+        clone.__select_related = list(self.__select_related)
+        clone.__prefetch_related = list(self.__prefetch_related)
+        clone.__result_cache = None
+        clone.__hydrate = None
+        return clone
+
+    def __partitions(self, partition_by, count):
+        meta = self.__table_class._meta
+        field = meta.fields.get(partition_by)
+        if field is None or field.cast_type != "INTEGER":
+            raise QueryException(
+                "Partition column must be an integer column: {}".format(partition_by)
+            )
+        if self.__limit is not None or self.__offset:
+            raise QueryException("Sliced queries cannot be partitioned.")
+        lookups = ["{}__{}".format(partition_by, i) for i in ("gte", "lt")]
+        if any(i in self.__filter_exclude_inputs["filter"] for i in lookups):
+            raise QueryException(
+                "Query already filters on {}.".format(", ".join(lookups))
+            )
+        low, high = self.__sql_row(
+            **self.__create_query(
+                aggregates=(("MIN", partition_by), ("MAX", partition_by))
+            )
+        )
+        if low is None:
+            return []
+        step = -(-(high - low + 1) // count)
+        partitions = []
+        for start in range(low, high + 1, step):
+            row_set = self.__clone()
+            row_set.__update_query_inputs(
+                {"filter": dict(zip(lookups, (start, min(start + step, high + 1))))}
+            )
+            partitions.append(row_set)
+        return partitions
+
+    def map_partitions(
+        self, fn, workers=None, partition_by="id", partitions=None, chunk_size=None
+    ):
+        workers = workers or os.cpu_count()
+        row_sets = self.__partitions(partition_by, partitions or workers)
+        if not row_sets:
+            return []
+        chunk_size = chunk_size or self.default_chunk_size
+        with ProcessPoolExecutor(max_workers=min(workers, len(row_sets))) as executor:
+            return list(
+                executor.map(
+                    partial(_scan_partition, chunk_size=chunk_size, fn=fn), row_sets
+                )
+            )
+
+    def parallel_iter(
+        self, workers=None, partition_by="id", partitions=None, chunk_size=None
+    ):
+        workers = workers or os.cpu_count()
+        row_sets = self.__partitions(partition_by, partitions or workers * 4)
+        if not row_sets:
+            return
+        chunk_size = chunk_size or self.default_chunk_size
+        with ProcessPoolExecutor(max_workers=min(workers, len(row_sets))) as executor:
+            for rows in executor.map(
+                partial(_scan_partition, chunk_size=chunk_size), row_sets
+            ):
+                for i in rows:
+                    yield i
+
+    def __keyset_columns(self):
+        pk_name = self.__table_class.get_pk_name()
+        columns = list(self.__filter_exclude_inputs["order_by"]) or [pk_name]
+        if pk_name not in columns:
+            columns.append(pk_name)
+        return columns
+
+    def __keyset_values(self, row, columns):
+        if isinstance(row, Table):
+            return tuple(
+                [Table.get_value_or_object_pk(getattr(row, i)) for i in columns]
+            )
+        if isinstance(row, dict):
+            try:
+                return tuple([row[i] for i in columns])
+            except KeyError as e:
+                raise QueryException("Keyset column not found: {}".format(e.args[0]))
+        if self.__values_mode in ("flat", "named", "tuple"):
+            return self.__values_row_keyset(row, columns)
+        if not isinstance(row, (list, tuple)):
+            row = (row,)
+        if len(row) != len(columns):
+            raise QueryException(
+                "Expected {} keyset values for {}.".format(
+                    len(columns), ", ".join(columns)
+                )
+            )
+        return tuple(row)
+
+    def __values_row_keyset(self, row, columns):
+        # values_list() rows are matched to the keyset through their fields.
+        pk_name = self.__table_class.get_pk_name()
+        fields = [pk_name if i == "pk" else i for i in self.__values_fields]
+        if self.__values_mode == "flat":
+            row = (row,)
+        missing = [i for i in columns if i not in fields]
+        if missing:
+            raise QueryException(
+                "values_list() rows must include the keyset columns: {}.".format(
+                    ", ".join(missing)
+                )
+            )
+        if len(row) != len(fields):
+            raise QueryException(
+                "Expected a values_list() row of {}.".format(", ".join(fields))
+            )
+        return tuple([row[fields.index(i)] for i in columns])
+
+    def paginate_after(self, last_values=None, page_size=100):
+        if last_values is not None:
+            last_values = self.__keyset_values(last_values, self.__keyset_columns())
+        clone = self.__clone()
+        clone.__keyset = True
+        clone.__seek = last_values
+        clone.__limit = page_size
+        clone.__offset = None
+        return clone.__fetch_all()
+
+    def iter_pages(self, page_size=100, last_values=None):
+        while True:
+            page = self.paginate_after(last_values, page_size)
+            if page:
+                yield page
+            if len(page) < page_size:
+                return
+            last_values = page[-1]
+
+    def __hydrate_rows(self, rows, chunk_size):
+        hydrate = self.__hydrate
+        prefetch_related = not self.__values_mode and self.__prefetch_related
+        timed = instrumentation.enabled and instrumentation.collecting_stats()
+        deferred = self.__query_deferred
+        if not (prefetch_related or timed or deferred):
+            for i in rows:
+                yield hydrate(i)
+            return
+        for chunk in self.__batches(rows, chunk_size):
+            started = time.perf_counter()
+            objs = [hydrate(i) for i in chunk]
+            if timed:
+                instrumentation.hydration_finished(time.perf_counter() - started)
+            if deferred:
+                self.__defer_columns(objs)
+            for path in prefetch_related or ():
+                prefetch_related_objects(objs, self.__table_class, path)
+            for obj in objs:
                 yield obj
-        else:
 
-            for i in self.__value:
-                yield i
+    def __fetch_all(self):
+        if self.__result_cache is None:
+            query = self.__create_query()
+            rows = self.__cached(query, lambda: list(self.__sql_read(**query)))
+            self.__result_cache = list(
+                self.__hydrate_rows(rows, self.prefetch_chunk_size)
+            )
+        return self.__result_cache
+
+    def __iter__(self):
+        return iter(self.__fetch_all())
+
+    def __len__(self):
+        return len(self.__fetch_all())
+
+    def __bool__(self):
+        return bool(self.__fetch_all())
 
     def __next__(self):
         return next(self.__iter__())
 
+    async def __aiter__(self):
+        if self.__result_cache is None:
+            self.__result_cache = await self.__afetch_all()
+        for i in self.__result_cache:
+            yield i
+
+    async def __afetch_all(self):
+        if self.__prefetch_related:
+            raise QueryException(
+                "prefetch_related is not supported in async iteration, "
+                "use select_related instead."
+            )
+        query = self.__create_query()
+        async with AsyncPostgreSQL() as pgsql:
+            await pgsql.query(query["query"], query["params"])
+            rows = pgsql.fetchall()
+        hydrate = self.__hydrate
+        started = time.perf_counter()
+        objs = [hydrate(i) for i in rows]
+        if instrumentation.enabled:
+            instrumentation.hydration_finished(time.perf_counter() - started)
+        if self.__query_deferred:
+            self.__defer_columns(objs)
+        return objs
+
+    def iterator(self, chunk_size=None):
+        chunk_size = chunk_size or self.default_chunk_size
+        query = self.__create_query()
+        with PostgreSQL() as pgsql:
+            rows = pgsql.stream_query_results(
+                query["query"], query["params"], itersize=chunk_size
+            )
+            try:
+                for i in self.__hydrate_rows(rows, chunk_size):
+                    yield i
+            finally:
+                rows.close()
+
     def __validate_kwargs(self, kwargs):
         for key in kwargs.keys():
             column_name = key.rsplit(LOGICAL_SEPARATOR, 1)[0]
@@ -213,18 +772,331 @@ class RowSet:
         obj.save(commit=True)
         return obj
 
-    def bulk_create(self, obj_list):
-        params = []
-        base_table = "{}.{}".format(
-            self.__table_class.get_schema(), self.__table_class.get_table_name()
+    @staticmethod
+    def __batches(iterable, batch_size):
+        iterator = iter(iterable)
+        while True:
+            batch = list(itertools.islice(iterator, batch_size))
+            if not batch:
+                return
+            yield batch
+
+    def __bulk_row_values(self, obj, column_names):
+        if isinstance(obj, Table):
+            values = [getattr(obj, k) for k in column_names]
+        else:
+            values = [obj.get(k) for k in column_names]
+        return tuple([Table.get_value_or_object_pk(v) for v in values])
+
+    def __bulk_create_sql_kwargs(self):
+        table_class = self.__table_class
+        meta = table_class._meta
+        return {
+            "schema": table_class.get_schema(),
+            "table_name": table_class.get_table_name(),
+            "column_names": ", ".join(
+                [meta.quoted_columns[i] for i in meta.non_pk_columns]
+            ),
+        }
+
+    def __get_insert_rows_query(self, returning):
+        meta = self.__table_class._meta
+        returning_sql = (
+            " RETURNING {}".format(meta.quoted_columns[meta.pk_name])
+            if returning
+            else ""
+        )
+        return SQL.insert_table_rows().format(
+            returning=returning_sql, **self.__bulk_create_sql_kwargs()
         )
-        column_names = [i for i in self.__table_class.get_column_names() if i != "id"]
-        columns = ['"{}"'.format(i) for i in column_names if i != "id"]
-        query = "INSERT INTO " + base_table + " (" + ", ".join(columns) + ") VALUES {};"
+
+    def bulk_create(
+        self,
+        obj_list,
+        batch_size=None,
+        method=None,
+        copy_format="text",
+        returning=False,
+    ):
+        if method is None:
+            method = "insert" if returning else "copy"
+        if method not in ("copy", "insert"):
+            raise QueryException("Unknown bulk create method: {}".format(method))
+        if returning and method != "insert":
+            raise QueryException("Primary keys can only be returned by insert.")
+        if copy_format not in ("text", "binary"):
+            raise QueryException("Unknown COPY format: {}".format(copy_format))
+
+        meta = self.__table_class._meta
+        column_names = meta.non_pk_columns
+        if method == "copy":
+            query = SQL.copy_table_rows().format(
+                format=copy_format, **self.__bulk_create_sql_kwargs()
+            )
+            encoders = [meta.fields[i].to_binary for i in column_names]
+            batch_size = batch_size or self.copy_batch_size
+        else:
+            query = self.__get_insert_rows_query(returning)
+            batch_size = batch_size or self.insert_batch_size
+
+        pks = []
+        row_count = 0
+        with PostgreSQL() as pgsql:
+            for batch in self.__batches(obj_list, batch_size):
+                rows = [self.__bulk_row_values(obj, column_names) for obj in batch]
+                if method == "copy":
+                    chunks = (
+                        copy_text_rows(rows)
+                        if copy_format == "text"
+                        else copy_binary_rows(rows, encoders)
+                    )
+                    row_count += pgsql.copy_from(query, chunks)
+                    continue
+                result = pgsql.execute_values(
+                    query, rows, page_size=batch_size, fetch=returning
+                )
+                row_count += len(rows)
+                if returning:
+                    batch_pks = [i[0] for i in result]
+                    for obj, pk in zip(batch, batch_pks):
+                        if isinstance(obj, Table):
+                            setattr(obj, meta.pk_name, pk)
+                    pks += batch_pks
+            pgsql.commit()
+        self.__invalidate_cache()
+        return pks if returning else row_count
+
+    async def abulk_create(self, obj_list, batch_size=None, returning=False):
+        meta = self.__table_class._meta
+        column_names = meta.non_pk_columns
+        query = self.__get_insert_rows_query(returning)
+        batch_size = batch_size or self.insert_batch_size
+
+        pks = []
+        row_count = 0
+        async with AsyncPostgreSQL() as pgsql:
+            await pgsql.begin()
+            for batch in self.__batches(obj_list, batch_size):
+                rows = [self.__bulk_row_values(obj, column_names) for obj in batch]
+                result = await pgsql.execute_values(
+                    query, rows, page_size=batch_size, fetch=returning
+                )
+                if not returning:
+                    row_count += result
+                    continue
+                batch_pks = [i[0] for i in result]
+                for obj, pk in zip(batch, batch_pks):
+                    if isinstance(obj, Table):
+                        setattr(obj, meta.pk_name, pk)
+                pks += batch_pks
+            await pgsql.commit()
+        self.__invalidate_cache()
+        return pks if returning else row_count
+
+    def __check_columns(self, column_names, allowed):
+        for i in column_names:
+            if i not in allowed:
+                raise QueryException("Column not found: {}".format(i))
+
+    def bulk_update(self, obj_list, fields, batch_size=None):
+        table_class = self.__table_class
+        meta = table_class._meta
+        if isinstance(fields, str):
+            fields = (fields,)
+        fields = tuple(fields)
+        if not fields:
+            raise QueryException("No fields given to update.")
+        self.__check_columns(fields, meta.non_pk_columns)
+
+        column_names = (meta.pk_name,) + fields
+        quoted_pk = meta.quoted_columns[meta.pk_name]
+        query = SQL.update_table_rows().format(
+            schema=table_class.get_schema(),
+            table_name=table_class.get_table_name(),
+            set_key_value=", ".join(
+                ["{0}=v.{0}".format(meta.quoted_columns[i]) for i in fields]
+            ),
+            column_names=", ".join([meta.quoted_columns[i] for i in column_names]),
+            pk=quoted_pk,
+        )
+        template = "({})".format(
+            ", ".join(["%s::{}".format(meta.fields[i].cast_type) for i in column_names])
+        )
+        batch_size = batch_size or self.insert_batch_size
+        # Iterated again below to mark the instances saved.
+        obj_list = list(obj_list)
+
+        row_count = 0
+        with PostgreSQL() as pgsql:
+            for batch in self.__batches(obj_list, batch_size):
+                rows = [self.__bulk_row_values(obj, column_names) for obj in batch]
+                if any(row[0] is None for row in rows):
+                    raise QueryException("Missing primary key for the given object.")
+                row_count += pgsql.execute_values(
+                    query, rows, page_size=len(rows), template=template
+                )
+            pgsql.commit()
+        self.__invalidate_cache()
         for obj in obj_list:
-            params.append(tuple([obj[k] for k in column_names]))
-        self.pgsql.insert_many(query, params=params)
-        self.pgsql.commit()
+            if isinstance(obj, Table):
+                transaction.record_saved(obj)
+                obj._mark_saved(fields)
+        return row_count
+
+    def bulk_upsert(self, rows, conflict_target, update_fields=None, batch_size=None):
+        table_class = self.__table_class
+        meta = table_class._meta
+        if isinstance(conflict_target, str):
+            conflict_target = (conflict_target,)
+        conflict_target = tuple(conflict_target)
+        self.__check_columns(conflict_target, meta.column_names)
+
+        column_names = meta.non_pk_columns
+        if meta.pk_name in conflict_target:
+            column_names = (meta.pk_name,) + column_names
+        if update_fields is None:
+            update_fields = [i for i in column_names if i not in conflict_target]
+        self.__check_columns(update_fields, meta.non_pk_columns)
+
+        if update_fields:
+            action = "UPDATE SET {}".format(
+                ", ".join(
+                    [
+                        "{0}=EXCLUDED.{0}".format(meta.quoted_columns[i])
+                        for i in update_fields
+                    ]
+                )
+            )
+        else:
+            action = "NOTHING"
+        query = SQL.upsert_table_rows().format(
+            schema=table_class.get_schema(),
+            table_name=table_class.get_table_name(),
+            column_names=", ".join([meta.quoted_columns[i] for i in column_names]),
+            conflict_target=", ".join(
+                [meta.quoted_columns[i] for i in conflict_target]
+            ),
+            action=action,
+        )
+        batch_size = batch_size or self.insert_batch_size
+
+        row_count = 0
+        with PostgreSQL() as pgsql:
+            for batch in self.__batches(rows, batch_size):
+                values = [self.__bulk_row_values(obj, column_names) for obj in batch]
+                row_count += pgsql.execute_values(query, values, page_size=len(values))
+            pgsql.commit()
+        self.__invalidate_cache()
+        return row_count
+
+    def __validate_fk_path(self, path):
+        table_class = self.__table_class
+        for fk in path.split(LOGICAL_SEPARATOR):
+            if fk not in table_class._meta.fk_targets:
+                raise QueryException("Foreign key not found: {}".format(path))
+            table_class = table_class._meta.fk_targets[fk]
+        return table_class
+
+    def __validate_column_paths(self, fields):
+        related = []
+        for field in fields:
+            path, _, column = field.rpartition(LOGICAL_SEPARATOR)
+            table_class = self.__validate_fk_path(path) if path else self.__table_class
+            if column not in table_class._meta.column_names:
+                raise QueryException("Column not found: {}".format(field))
+            if path and path not in self.__select_related + related:
+                related.append(path)
+        return related
+
+    def only(self, *fields):
+        """
+        Loads only `fields` of this table and of the related tables named by
+        paths like `owner__name`, which are joined in as by `select_related`.
+        Primary keys and the keys of joined tables are always loaded.
+        """
+        related = self.__validate_column_paths(fields)
+        clone = self.__clone()
+        clone.__only = tuple(fields)
+        clone.__select_related += related
+        return clone
+
+    def defer(self, *fields):
+        """
+        Skips `fields` when loading rows. A deferred column is loaded for the
+        whole batch of rows with one query the first time it is read.
+        """
+        related = self.__validate_column_paths(fields)
+        clone = self.__clone()
+        clone.__deferred += tuple(fields)
+        clone.__select_related += related
+        return clone
+
+    def __get_deferred_columns(self):
+        if not (self.__only or self.__deferred):
+            return ()
+        tables = {"": self.__table_class}
+        kept = {"": set()}
+        for path in self.__select_related:
+            parent = ""
+            for fk in path.split(LOGICAL_SEPARATOR):
+                kept.setdefault(parent, set()).add(fk)
+                child = parent + LOGICAL_SEPARATOR + fk if parent else fk
+                tables[child] = tables[parent]._meta.fk_targets[fk]
+                kept.setdefault(child, set())
+                parent = child
+        deferred = {}
+        for field in self.__deferred:
+            path, _, column = field.rpartition(LOGICAL_SEPARATOR)
+            deferred.setdefault(path, set()).add(column)
+        if self.__only:
+            only = {"": set()}
+            for field in self.__only:
+                path, _, column = field.rpartition(LOGICAL_SEPARATOR)
+                only.setdefault(path, set()).add(column)
+            for path, columns in only.items():
+                deferred.setdefault(path, set()).update(tables[path]._meta.column_names)
+                deferred[path] -= columns
+        result = []
+        for path, columns in sorted(deferred.items()):
+            meta = tables[path]._meta
+            columns = columns - kept[path] - {meta.pk_name}
+            if columns:
+                result.append((path, tuple(sorted(columns))))
+        return tuple(result)
+
+    def __defer_columns(self, objs):
+        for path, column_names in self.__query_deferred:
+            table_class = self.__table_class
+            instances = objs
+            for fk in path.split(LOGICAL_SEPARATOR) if path else ():
+                table_class = table_class._meta.fk_targets[fk]
+                instances = [
+                    i
+                    for i in [getattr(obj, fk) for obj in instances]
+                    if isinstance(i, Table)
+                ]
+            deferred = DeferredColumns(table_class, column_names, instances)
+            for obj in instances:
+                # Instances from the identity map keep the loader of the
+                # batch that first loaded them.
+                if getattr(obj, "_deferred", None) is None:
+                    obj._deferred = deferred
+
+    def select_related(self, *fields):
+        for field in fields:
+            self.__validate_fk_path(field)
+        clone = self.__clone()
+        clone.__select_related += fields
+        return clone
+
+    def prefetch_related(self, *fields):
+        for field in fields:
+            self.__validate_fk_path(field)
+        clone = self.__clone()
+        clone.__prefetch_related += [
+            i for i in fields if i not in clone.__prefetch_related
+        ]
+        return clone
 
     def order_by(self, params):
         data = {}
@@ -236,28 +1108,45 @@ class RowSet:
             if column_name not in self.__table_columns:
                 raise QueryException("Column not found: {}".format(column_name))
             data[column_name] = order
-        self.__update_query_inputs({"order_by": data})
-        return self
+        return self.__chain({"order_by": data})
+
+    def __chain(self, data):
+        clone = self.__clone()
+        clone.__update_query_inputs(data)
+        return clone
 
     def all(self):
-        self.__update_query_inputs({})
-        return self
+        return self.__clone()
 
     def filter(self, **kwargs):
-        self.__update_query_inputs({"filter": kwargs})
-        return self
+        return self.__chain({"filter": kwargs})
 
     def or_filter(self, **kwargs):
-        self.__update_query_inputs({"or_filter": kwargs})
-        return self
+        return self.__chain({"or_filter": kwargs})
 
     def exclude(self, **kwargs):
-        self.__update_query_inputs({"exclude": kwargs})
-        return self
+        return self.__chain({"exclude": kwargs})
+
+    def __filtered_pk(self):
+        # The primary key this set is narrowed to, if that is its only filter.
+        inputs = self.__filter_exclude_inputs
+        if inputs["or_filter"] or inputs["exclude"] or len(inputs["filter"]) != 1:
+            return None
+        if self.__limit is not None or self.__offset or self.__values_mode:
+            return None
+        key, value = next(iter(inputs["filter"].items()))
+        if key not in ("pk", self.__table_class.get_pk_name()):
+            return None
+        return Table.get_value_or_object_pk(value)
 
     def get(self, **kwargs):
-        self.__filter_exclude_inputs["filter"] = kwargs
-        objects_found = [i for i in self.__iter__()]
+        row_set = self.filter(**kwargs)
+        objects = identity.get_identity_map()
+        if objects is not None:
+            obj = objects.get(self.__table_class._meta.model, row_set.__filtered_pk())
+            if obj is not None:
+                return obj
+        objects_found = row_set.__fetch_all()
         if not objects_found:
             raise ObjectDoesNotExist("Object does not exist.")
         if len(objects_found) > 1:
@@ -265,12 +1154,38 @@ class RowSet:
         return objects_found[0]
 
     def delete(self):
-        self.__delete = True
-        self.__sql_delete(**self.__create_query())
+        clone = self.__clone()
+        clone.__delete = True
+        clone.__sql_delete(**clone.__create_query())
+        self.__result_cache = None
+        objects = identity.get_identity_map()
+        if objects is not None:
+            pk = self.__filtered_pk()
+            if pk is None:
+                objects.discard_model(self.__table_class._meta.model)
+            else:
+                objects.discard(self.__table_class._meta.model, pk)
+
+    def __cached_scalar(self, query):
+        return self.__cached(query, lambda: [self.__sql_scalar(**query)])[0]
 
     def count(self):
-        self.__value = [i for i in self]
-        return len(self.__value) if self.__value else 0
+        if self.__result_cache is not None:
+            return len(self.__result_cache)
+        return self.__cached_scalar(self.__create_query(count=True))
+
+    async def acount(self):
+        if self.__result_cache is not None:
+            return len(self.__result_cache)
+        query = self.__create_query(count=True)
+        async with AsyncPostgreSQL() as pgsql:
+            await pgsql.query(query["query"], query["params"])
+            return pgsql.fetchone()[0]
+
+    def exists(self):
+        if self.__result_cache is not None:
+            return bool(self.__result_cache)
+        return self.__cached_scalar(self.__create_query(exists=True)) is not None
 
 
 class Objects:
@@ -281,7 +1196,7 @@ class Objects:
         return self.row_set
 
 
-class Table:
+class Table(metaclass=TableMeta):
 
     database_type = None
 
@@ -289,8 +1204,35 @@ class Table:
     objects = Objects()
 
     def __init__(self, **kwargs):
-        for i in self.__class__.get_column_names():
+        for i in self.__class__._meta.column_names:
             self.__dict__[i] = kwargs.get(i)
+        self.__dict__["_loaded_values"] = None
+
+    @classmethod
+    def _from_db(cls, column_names, values, raw_values=None):
+        obj = cls.__new__(cls)
+        obj_values = obj.__dict__
+        obj_values.update(zip(column_names, values))
+        obj_values["_loaded_values"] = (
+            column_names,
+            values if raw_values is None else raw_values,
+        )
+        return obj
+
+    @classmethod
+    def compact_class(cls):
+        meta = cls._meta
+        if meta.compact_class is None:
+            meta.compact_class = TableMeta(
+                "{}Row".format(meta.model.__name__),
+                (CompactRow, meta.model),
+                {
+                    "__slots__": meta.column_names + ("_loaded_values", "_deferred"),
+                    "__module__": meta.model.__module__,
+                    "_meta": meta,
+                },
+            )
+        return meta.compact_class
 
     def __getattribute__(self, item: str):
         if item.startswith("__"):
@@ -298,8 +1240,13 @@ class Table:
         try:
             return self.__dict__[item]
         except KeyError:
+            if item in self.__class__._meta.fields:
+                return _load_deferred(self, item)
             return object.__getattribute__(self, item)
 
+    def _is_loaded(self, column_name):
+        return column_name in self.__dict__
+
     def __setattr__(self, key: str, value):
         if key.startswith("__"):
             object.__setattr__(self, key, value)
@@ -341,34 +1288,43 @@ class Table:
 
     @classmethod
     def _get_column_fields(cls):
-        valid_column_names = cls.get_column_names()
-        return {k: v for k, v in cls.__dict__.items() if k in valid_column_names}
+        return cls._meta.fields
 
     @classmethod
     def _get_meta_field(cls):
-        return cls.__dict__.get("Meta")
+        return cls._meta.meta_field
 
     @classmethod
     def get_column_names(cls):
-        names = []
+        return list(cls._meta.column_names)
+
+    @classmethod
+    def get_live_column_names(cls):
         with PostgreSQL() as pgsql:
             pgsql.query(
-                SQL.get_table_columns(), [cls.__name__.lower(), cls.get_schema()]
+                SQL.get_table_columns(), [cls.get_table_name(), cls.get_schema()]
             )
-            names = [name[0] for name in pgsql.fetchall()]
+            return sorted(name[0] for name in pgsql.fetchall())
 
-        if not names:
-            for k, v in cls.__dict__.items():
-                class_inspects = inspect.getmro(v.__class__)
-                if len(class_inspects) > 1 and class_inspects[-2] == BaseField:
-                    if k != k.lower():
-                        raise SQLException("Column names should be in lowercase.")
-                    names.append(k)
-        return sorted(names)
+    @classmethod
+    def reconcile_columns(cls, strict=False):
+        live_columns = set(cls.get_live_column_names())
+        declared_columns = set(cls._meta.column_names)
+        diff = {
+            "missing": sorted(declared_columns - live_columns),
+            "unexpected": sorted(live_columns - declared_columns),
+        }
+        if strict and (diff["missing"] or diff["unexpected"]):
+            raise SQLException(
+                "Table {} is out of sync with its model: {}".format(
+                    cls.get_full_table_name(), diff
+                )
+            )
+        return diff
 
     @classmethod
     def get_table_name(cls):
-        return cls.__name__.lower()
+        return cls._meta.table_name
 
     @classmethod
     def __create_columns(cls):
@@ -383,7 +1339,7 @@ class Table:
     def __create_meta_properties(cls):
         meta_queries = []
         meta_field = cls._get_meta_field()
-        column_names = cls.get_column_names()
+        column_names = cls._meta.column_names
         if meta_field:
             unique_together = meta_field.__dict__.get("unique_together", ())
             for i in unique_together:
@@ -406,6 +1362,8 @@ class Table:
 
     @classmethod
     def get_value_or_object_pk(cls, value):
+        if isinstance(value, ForeignKeyField):
+            return value.get_value()
         return getattr(value, "pk") if hasattr(value, "pk") else value
 
     def __get_field_value(self, field_name):
@@ -431,36 +1389,71 @@ class Table:
 
     @property
     def pk(self):
-        for k, v in self.__class__._get_column_fields().items():
-            if v.primary_key:
-                return getattr(self, k)
+        pk_name = self.__class__._meta.pk_name
+        if pk_name:
+            return getattr(self, pk_name)
 
     @classmethod
     def get_pk_name(cls):
-        for k, v in cls._get_column_fields().items():
-            if v.primary_key:
-                return k
-
-    def _sql_save(self, commit=True):
-        if getattr(self, "pk"):
-            pk_name = self.__class__.get_pk_name()
-            column_names = [
-                i for i in self.__class__.get_column_names() if i != pk_name
+        return cls._meta.pk_name
+
+    def get_dirty_fields(self):
+        meta = self.__class__._meta
+        loaded_values = self._loaded_values
+        if loaded_values is None:
+            return list(meta.non_pk_columns)
+        dirty_fields = [
+            k
+            for k, v in zip(*loaded_values)
+            if k != meta.pk_name and self.__get_field_value(k) != v
+        ]
+        if len(loaded_values[0]) < len(meta.column_names):
+            # Deferred columns that were assigned without being loaded.
+            dirty_fields += [
+                k
+                for k in meta.non_pk_columns
+                if k not in loaded_values[0] and self._is_loaded(k)
             ]
+        return dirty_fields
+
+    def _mark_saved(self, column_names):
+        loaded_values = dict(zip(*self._loaded_values)) if self._loaded_values else {}
+        for i in column_names:
+            loaded_values[i] = self.__get_field_value(i)
+        self._loaded_values = (tuple(loaded_values), tuple(loaded_values.values()))
+
+    def __get_save_query(self, update_fields=None):
+        """
+        Returns the statement that saves this instance, its params and the
+        updated columns, which are None for an INSERT.
+        """
+        meta = self.__class__._meta
+        if getattr(self, "pk"):
+            if update_fields is None:
+                column_names = self.get_dirty_fields()
+            else:
+                column_names = list(update_fields)
+                for i in column_names:
+                    if i not in meta.non_pk_columns:
+                        raise SQLException(
+                            "Column {} cannot be updated on the model {}.".format(
+                                i, self.__class__.get_table_name()
+                            )
+                        )
+            if not column_names:
+                return None, None, None
             params = [self.__get_field_value(i) for i in column_names] + [self.pk]
             query = SQL.update_table_row().format(
                 schema=self.__class__.get_schema(),
                 table_name=self.__class__.get_table_name(),
-                set_key_value=", ".join(['"{}"=%s'.format(i) for i in column_names]),
-                condition='"{}"=%s'.format(pk_name),
+                set_key_value=", ".join(
+                    ["{}=%s".format(meta.quoted_columns[i]) for i in column_names]
+                ),
+                condition="{}=%s".format(meta.quoted_columns[meta.pk_name]),
             )
-            with PostgreSQL() as pgsql:
-                pgsql.query(query, params=params)
-                pgsql.commit()
+            return query, params, column_names
         else:
-            column_names = [
-                '"{}"'.format(i) for i in self.__class__.get_column_names() if i != "id"
-            ]
+            column_names = [meta.quoted_columns[i] for i in meta.non_pk_columns]
             params = [self.__get_field_value(i) for i in column_names]
             query = SQL.insert_table_row().format(
                 schema=self.__class__.get_schema(),
@@ -468,16 +1461,45 @@ class Table:
                 column_names=", ".join(column_names),
                 column_values=", ".join(["%s"] * len(column_names)),
             )
-            obj_id = None
+            return query, params, None
+
+    def __set_saved(self, column_names, row):
+        cache.invalidate(self.__class__.get_full_table_name())
+        if column_names is None:
+            meta = self.__class__._meta
+            setattr(self, meta.pk_name, row[0])
+            column_names = meta.column_names
+            objects = identity.get_identity_map()
+            if objects is not None:
+                objects.add(self)
+        self._mark_saved(column_names)
+
+    def _sql_save(self, commit=True, update_fields=None):
+        if not commit and get_bound_connection() is None:
+            # The pooled connection would roll the write back on release.
+            raise SQLException("save(commit=False) can only be used inside atomic().")
+        query, params, column_names = self.__get_save_query(update_fields)
+        if query is None:
+            return
+        with PostgreSQL() as pgsql:
+            pgsql.query(query, params=params)
+            row = pgsql.fetchone() if column_names is None else None
             if commit:
-                with PostgreSQL() as pgsql:
-                    pgsql.query(query, params=params)
-                    obj_id = pgsql.fetchone()[0]
-                    pgsql.commit()
-            self.__dict__["id"] = obj_id
+                pgsql.commit()
+        transaction.record_saved(self, inserted=column_names is None)
+        self.__set_saved(column_names, row)
 
-    def save(self, commit=True):
-        self._sql_save(commit=commit)
+    async def asave(self, update_fields=None):
+        query, params, column_names = self.__get_save_query(update_fields)
+        if query is None:
+            return
+        async with AsyncPostgreSQL() as pgsql:
+            await pgsql.query(query, params=params)
+            row = pgsql.fetchone() if column_names is None else None
+        self.__set_saved(column_names, row)
+
+    def save(self, commit=True, update_fields=None):
+        self._sql_save(commit=commit, update_fields=update_fields)
 
     def delete(self):
         if getattr(self, "pk"):
@@ -485,5 +1507,12 @@ class Table:
         else:
             raise SQLException("Missing primary key for the given object.")
 
+    def refresh_from_db(self):
+        with identity.suspended():
+            obj = self.__class__.objects.get(pk=self.pk)
+        for column in self.__class__._meta.column_names:
+            setattr(self, column, getattr(obj, column))
+        self._loaded_values = obj._loaded_values
+
     def as_dict(self):
-        return {k: self.__dict__.get(k) for k in self.__class__.get_column_names()}
+        return {k: getattr(self, k) for k in self.__class__._meta.column_names}
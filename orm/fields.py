@@ -1,5 +1,7 @@
+import struct
 from copy import deepcopy
 
+from orm import identity
 from orm.commands import SQL
 
 __all__ = [
@@ -23,6 +25,7 @@ class BaseField:
 class Field(BaseField):
 
     field_type = None
+    binary_format = None
 
     def __init__(
         self,
@@ -36,6 +39,7 @@ class Field(BaseField):
         self.__value = None
         self.verbose_name = verbose_name
         self.primary_key = primary_key
+        self.null = null and not primary_key
         if primary_key:
             self.properties = "PRIMARY KEY"
         else:
@@ -71,10 +75,29 @@ class Field(BaseField):
     def set_value(self, value):
         self.__value = value
 
+    def get_value(self):
+        return self.__value
+
+    def bind(self, value):
+        field = self.__class__.__new__(self.__class__)
+        field.__dict__.update(self.__dict__)
+        field.__value = value
+        return field
+
+    @property
+    def cast_type(self):
+        return "INTEGER" if self.field_type == "SERIAL" else self.field_type
+
+    def to_binary(self, value):
+        if self.binary_format:
+            return struct.pack(self.binary_format, value)
+        return str(value).encode("utf-8")
+
 
 class BooleanField(Field):
 
     field_type = "BOOLEAN"
+    binary_format = "!?"
 
     @staticmethod
     def convert(value):
@@ -84,6 +107,7 @@ class BooleanField(Field):
 class IntegerField(Field):
 
     field_type = "INTEGER"
+    binary_format = "!i"
 
     @staticmethod
     def convert(value):
@@ -129,20 +153,36 @@ class ForeignKeyField(Field):
             table_name=table_name.get_table_name(),
             pk=pk,
         )
-        self.field_type = (
-            "INTEGER" if self.field.field_type == "SERIAL" else self.field.field_type
-        )
+        self.field_type = self.field.cast_type
+        self.binary_format = self.field.binary_format
         super().__init__(
             verbose_name=verbose_name, null=null, unique=unique, extra_sql=(extra_sql,)
         )
+        self.__related_object = None
 
     def __getattribute__(self, item):
         try:
             return object.__getattribute__(self, item)
         except AttributeError:
-            return getattr(
-                self.__dict__["table_name"].objects.get(
-                    pk=self.__dict__["_Field__value"]
-                ),
-                item,
-            )
+            if item.startswith("__"):
+                raise
+            return getattr(self.get_related_object(), item)
+
+    def set_value(self, value):
+        super().set_value(value)
+        self.__related_object = None
+
+    def bind(self, value):
+        field = super().bind(value)
+        field.__related_object = None
+        return field
+
+    def get_related_object(self):
+        if self.__related_object is None:
+            self.__related_object = self.table_name.objects.get(pk=self.get_value())
+        return self.__related_object
+
+    def refresh_from_db(self):
+        self.__related_object = None
+        with identity.suspended():
+            return self.get_related_object()
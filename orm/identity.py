@@ -0,0 +1,91 @@
+import contextvars
+from contextlib import contextmanager
+
+_active_map = contextvars.ContextVar("identity_map", default=None)
+# Instances added inside the innermost transaction block, dropped if it rolls back.
+_block_additions = contextvars.ContextVar("identity_block_additions", default=None)
+
+
+class IdentityMap:
+    """
+    The model instances loaded in one unit of work, keyed on their model and
+    primary key.
+    """
+
+    def __init__(self):
+        self._objects = {}
+
+    def get(self, model, pk):
+        return self._objects.get((model, pk))
+
+    def add(self, obj):
+        key = (obj._meta.model, obj.pk)
+        current = self._objects.setdefault(key, obj)
+        additions = _block_additions.get()
+        if current is obj and additions is not None:
+            additions.append((self, key, obj))
+        return current
+
+    def discard(self, model, pk):
+        self._objects.pop((model, pk), None)
+
+    def discard_model(self, model):
+        for key in [i for i in self._objects if i[0] is model]:
+            del self._objects[key]
+
+    def clear(self):
+        self._objects.clear()
+
+    def __contains__(self, obj):
+        return self._objects.get((obj._meta.model, obj.pk)) is obj
+
+    def __len__(self):
+        return len(self._objects)
+
+
+def get_identity_map():
+    return _active_map.get()
+
+
+@contextmanager
+def identity_map():
+    """
+    Makes rows loaded by the current thread or task inside the block resolve
+    to one instance per model and primary key. Nested blocks share the
+    outermost map.
+    """
+    current = _active_map.get()
+    if current is not None:
+        yield current
+        return
+    token = _active_map.set(IdentityMap())
+    try:
+        yield _active_map.get()
+    finally:
+        _active_map.reset(token)
+
+
+@contextmanager
+def suspended():
+    token = _active_map.set(None)
+    try:
+        yield
+    finally:
+        _active_map.reset(token)
+
+
+def track_additions():
+    return _block_additions.set([])
+
+
+def end_tracking(token, rolled_back):
+    additions = _block_additions.get()
+    _block_additions.reset(token)
+    if rolled_back:
+        for objects, key, obj in additions:
+            if objects._objects.get(key) is obj:
+                del objects._objects[key]
+        return
+    parent = _block_additions.get()
+    if parent is not None:
+        parent.extend(additions)
@@ -0,0 +1,131 @@
+import contextvars
+import threading
+from contextlib import contextmanager
+
+HOOK_EVENTS = ("before_execute", "after_execute")
+
+_hooks = {event: [] for event in HOOK_EVENTS}
+_active_stats = contextvars.ContextVar("active_stats", default=())
+_stats_depth = 0
+_lock = threading.Lock()
+
+# Checked before every statement; while False no timing or dispatch happens.
+enabled = False
+
+
+def _update_enabled():
+    global enabled
+    enabled = bool(_stats_depth or any(_hooks.values()))
+
+
+def register_hook(event, hook):
+    """
+    Registers `hook` for `event`. `before_execute` hooks are called with
+    `(sql, params)` and `after_execute` hooks with
+    `(sql, params, duration, rows, error)`.
+    """
+    if event not in _hooks:
+        raise ValueError("Unknown hook event: {}".format(event))
+    with _lock:
+        _hooks[event] = _hooks[event] + [hook]
+        _update_enabled()
+
+
+def unregister_hook(event, hook):
+    with _lock:
+        _hooks[event] = [i for i in _hooks.get(event, ()) if i != hook]
+        _update_enabled()
+
+
+def before_execute(sql, params):
+    for hook in _hooks["before_execute"]:
+        hook(sql, params)
+
+
+def after_execute(sql, params, duration, rows, error=None):
+    for hook in _hooks["after_execute"]:
+        hook(sql, params, duration, rows, error)
+    for stats in _active_stats.get():
+        stats.add_query(sql, duration, rows)
+
+
+def collecting_stats():
+    return bool(_active_stats.get())
+
+
+def hydration_finished(duration):
+    for stats in _active_stats.get():
+        stats.hydration_time += duration
+
+
+def connection_opened():
+    if enabled:
+        for stats in _active_stats.get():
+            stats.connections_opened += 1
+
+
+class QueryStats:
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.rows = 0
+        self.hydration_time = 0.0
+        self.connections_opened = 0
+        self.statements = []
+
+    def add_query(self, sql, duration, rows):
+        self.queries += 1
+        self.db_time += duration
+        self.rows += max(rows, 0)
+        self.statements.append(sql)
+
+    def as_dict(self):
+        return {
+            "queries": self.queries,
+            "db_time": self.db_time,
+            "rows": self.rows,
+            "hydration_time": self.hydration_time,
+            "connections_opened": self.connections_opened,
+        }
+
+    def __repr__(self):
+        return "QueryStats({})".format(
+            ", ".join("{}={!r}".format(k, v) for k, v in self.as_dict().items())
+        )
+
+
+@contextmanager
+def query_stats():
+    """
+    Collects statistics for the statements run by the current thread or task
+    inside the block.
+    """
+    global _stats_depth
+    stats = QueryStats()
+    token = _active_stats.set(_active_stats.get() + (stats,))
+    with _lock:
+        _stats_depth += 1
+        _update_enabled()
+    try:
+        yield stats
+    finally:
+        _active_stats.reset(token)
+        with _lock:
+            _stats_depth -= 1
+            _update_enabled()
+
+
+@contextmanager
+def assert_max_queries(count):
+    with query_stats() as stats:
+        yield stats
+    if stats.queries > count:
+        raise AssertionError(
+            "{} queries executed, expected at most {}:\n{}".format(
+                stats.queries,
+                count,
+                "\n".join(
+                    "{}. {}".format(i, sql) for i, sql in enumerate(stats.statements, 1)
+                ),
+            )
+        )
@@ -1,26 +1,399 @@
+import contextvars
+import itertools
+import logging
 import os
+import re
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
 
 import psycopg2
+from psycopg2 import extensions
+from psycopg2.extras import execute_values
 
+from orm import querylog  # noqa: F401 - applies the DB_QUERY_LOG settings
+from orm import instrumentation
 
-class PostgreSQL:
-    def __init__(self):
-        credentials = {
-            "host": os.getenv("DB_HOST"),
-            "port": int(os.getenv("DB_PORT")),
-            "database": os.getenv("DB_NAME"),
-            "user": os.getenv("DB_USER"),
-            "password": os.getenv("DB_PASSWORD"),
-        }
+logger = logging.getLogger(__name__)
+
+ITERATOR_CHUNK_SIZE = int(os.getenv("DB_ITERATOR_CHUNK_SIZE") or 2000)
+
+
+class PoolTimeoutException(Exception):
+    pass
+
+
+class PoolClosedException(Exception):
+    pass
+
+
+class PreparedStatementRegistry:
+    """
+    Statements prepared on one connection. A statement is prepared once it
+    has been executed `threshold` times and the least recently used one is
+    deallocated when more than `maxsize` are held.
+    """
+
+    placeholder = re.compile(r"%([%s])")
+
+    def __init__(self, threshold, maxsize=100):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self._counts = {}
+        self._statements = OrderedDict()
+        self._names = itertools.count()
+
+    def __len__(self):
+        return len(self._statements)
+
+    def __contains__(self, sql):
+        return sql in self._statements
+
+    @classmethod
+    def to_positional(cls, sql):
+        position = itertools.count(1)
+        return cls.placeholder.sub(
+            lambda m: "%" if m.group(1) == "%" else "${}".format(next(position)),
+            sql,
+        )
+
+    def get_statement(self, cursor, sql):
+        statement = self._statements.get(sql)
+        if statement is not None:
+            self._statements.move_to_end(sql)
+            return statement
+        count = self._counts.get(sql, 0) + 1
+        if count < self.threshold:
+            if len(self._counts) >= self.maxsize * 10:
+                self._counts.clear()
+            self._counts[sql] = count
+            return None
+        self._counts.pop(sql, None)
+        while len(self._statements) >= self.maxsize:
+            _, (old_name, _) = self._statements.popitem(last=False)
+            cursor.execute("DEALLOCATE {}".format(old_name))
+
+        name = "orm_stmt_{}".format(next(self._names))
+        positional_sql = self.to_positional(sql)
+        cursor.execute("PREPARE {} AS {}".format(name, positional_sql))
+        param_count = self.placeholder.findall(sql).count("s")
+        execute_sql = "EXECUTE {}".format(name)
+        if param_count:
+            execute_sql += " ({})".format(", ".join(["%s"] * param_count))
+        statement = (name, execute_sql)
+        self._statements[sql] = statement
+        return statement
+
+    def clear(self, cursor):
+        cursor.execute("DEALLOCATE ALL")
+        self._statements.clear()
+        self._counts.clear()
+
+
+class PooledConnection(extensions.connection):
+    prepared_statements = None
+
+
+def get_credentials():
+    return {
+        "host": os.getenv("DB_HOST"),
+        "port": int(os.getenv("DB_PORT")),
+        "database": os.getenv("DB_NAME"),
+        "user": os.getenv("DB_USER"),
+        "password": os.getenv("DB_PASSWORD"),
+    }
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of psycopg2 connections.
+
+    Connections are leased with `getconn` and handed back with `putconn`.
+    At most `max_size` connections are open at once; a lease blocks for up to
+    `timeout` seconds waiting for one to be returned before giving up. Idle
+    connections are health checked on checkout.
+    """
+
+    def __init__(
+        self,
+        min_size=1,
+        max_size=10,
+        timeout=30.0,
+        health_check_interval=30.0,
+        prepare_threshold=0,
+        max_prepared_statements=100,
+        credentials=None,
+    ):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise ValueError(
+                "Invalid pool size: min_size={}, max_size={}".format(min_size, max_size)
+            )
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.health_check_interval = health_check_interval
+        self.prepare_threshold = prepare_threshold
+        self.max_prepared_statements = max_prepared_statements
+        self.pid = os.getpid()
+        self._credentials = credentials
+        self._idle = deque()
+        self._size = 0
+        self._closed = False
+        self._lock = threading.Condition()
+        for _ in range(min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    def _connect(self):
+        credentials = self._credentials or get_credentials()
         try:
-            self._conn = psycopg2.connect(**credentials)
-            self._cursor = self._conn.cursor()
-            print("\nConnected to PostgreSQL\n")
+            conn = psycopg2.connect(connection_factory=PooledConnection, **credentials)
+            if self.prepare_threshold:
+                conn.prepared_statements = PreparedStatementRegistry(
+                    threshold=self.prepare_threshold,
+                    maxsize=self.max_prepared_statements,
+                )
+            instrumentation.connection_opened()
+            logger.debug("Connected to PostgreSQL")
+            return conn
         except psycopg2.Error as error:
             raise ValueError(
                 "Unable to connect to PostgreSQL database\n{error}".format(error=error)
             )
 
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if time.monotonic() - last_used < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+            logger.debug("Closed PostgreSQL connection.")
+        except psycopg2.Error:
+            pass
+        with self._lock:
+            self._size -= 1
+            self._lock.notify()
+
+    def getconn(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                while True:
+                    if self._closed:
+                        raise PoolClosedException("Connection pool is closed.")
+                    if self._idle:
+                        conn, last_used = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        conn, last_used = None, None
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeoutException(
+                            "Timed out after {}s waiting for a connection.".format(
+                                timeout
+                            )
+                        )
+                    self._lock.wait(remaining)
+
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._lock:
+                        self._size -= 1
+                        self._lock.notify()
+                    raise
+            if self._is_healthy(conn, last_used):
+                return conn
+            self._discard(conn)
+
+    def putconn(self, conn):
+        if not conn.closed:
+            status = conn.info.transaction_status
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                conn.close()
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    conn.close()
+        with self._lock:
+            if not self._closed and not conn.closed:
+                self._idle.append((conn, time.monotonic()))
+                self._lock.notify()
+                return
+        self._discard(conn)
+
+    def closeall(self):
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, deque()
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+# Pools inherited across a fork share their sockets with the parent process.
+# They are kept referenced so that garbage collection in the child never
+# terminates the parent's sessions.
+_inherited_pools = []
+
+
+def _pool_settings():
+    return {
+        "min_size": int(os.getenv("DB_POOL_MIN_SIZE") or 1),
+        "max_size": int(os.getenv("DB_POOL_MAX_SIZE") or 10),
+        "timeout": float(os.getenv("DB_POOL_TIMEOUT") or 30),
+        "health_check_interval": float(os.getenv("DB_POOL_HEALTH_CHECK") or 30),
+        "prepare_threshold": int(os.getenv("DB_PREPARE_THRESHOLD") or 0),
+        "max_prepared_statements": int(os.getenv("DB_MAX_PREPARED_STATEMENTS") or 100),
+    }
+
+
+def get_pool():
+    global _pool
+    pool = _pool
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _pool_lock:
+        if _pool is not None and _pool.pid != os.getpid():
+            _inherited_pools.append(_pool)
+            _pool = None
+        if _pool is None:
+            _pool = ConnectionPool(**_pool_settings())
+        return _pool
+
+
+def configure_pool(**kwargs):
+    global _pool
+    settings = _pool_settings()
+    settings.update(kwargs)
+    with _pool_lock:
+        old_pool, _pool = _pool, ConnectionPool(**settings)
+    if old_pool is not None and old_pool.pid == os.getpid():
+        old_pool.closeall()
+    return _pool
+
+
+COPY_BINARY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+COPY_BINARY_TRAILER = struct.pack("!h", -1)
+
+
+def _copy_text_value(value):
+    if value is None:
+        return "\\N"
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def copy_text_rows(rows):
+    for row in rows:
+        yield ("\t".join([_copy_text_value(v) for v in row]) + "\n").encode("utf-8")
+
+
+def copy_binary_rows(rows, encoders):
+    yield COPY_BINARY_HEADER
+    field_count = struct.pack("!h", len(encoders))
+    for row in rows:
+        data = [field_count]
+        for encode, value in zip(encoders, row):
+            if value is None:
+                data.append(struct.pack("!i", -1))
+            else:
+                value = encode(value)
+                data.append(struct.pack("!i", len(value)))
+                data.append(value)
+        yield b"".join(data)
+    yield COPY_BINARY_TRAILER
+
+
+class CopyStream:
+    """
+    File-like reader over an iterable of byte chunks, letting `COPY ... FROM
+    STDIN` pull rows lazily instead of from a fully built buffer.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = bytearray()
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    readline = read
+
+
+_cursor_names = itertools.count()
+
+
+_bound_connection = contextvars.ContextVar("bound_connection", default=None)
+
+
+def get_bound_connection():
+    return _bound_connection.get()
+
+
+def bind_connection(conn):
+    return _bound_connection.set(conn)
+
+
+def unbind_connection(token):
+    _bound_connection.reset(token)
+
+
+class PostgreSQL:
+    def __init__(self, pool=None):
+        bound_connection = get_bound_connection() if pool is None else None
+        # Inside a transaction block every instance shares the bound connection
+        # and leaves committing and returning it to the block.
+        self._bound = bound_connection is not None
+        if self._bound:
+            self._pool = None
+            self._conn = bound_connection
+        else:
+            self._pool = pool if pool is not None else get_pool()
+            self._conn = self._pool.getconn()
+        self._cursor = self._conn.cursor()
+
     def __enter__(self):
         return self
 
@@ -31,8 +404,14 @@ class PostgreSQL:
         self.close()
 
     def close(self):
-        self.connection.close()
-        print("\nClosed PostgreSQL connection.\n")
+        conn = getattr(self, "_conn", None)
+        if conn is None:
+            return
+        self._conn = None
+        if not self._cursor.closed:
+            self._cursor.close()
+        if not self._bound:
+            self._pool.putconn(conn)
 
     @property
     def connection(self):
@@ -43,11 +422,46 @@ class PostgreSQL:
         return self._cursor
 
     def commit(self):
-        self.connection.commit()
+        if not self._bound:
+            self.connection.commit()
+
+    def _instrumented(self, cursor, sql, params, execute, *args, **kwargs):
+        if not instrumentation.enabled:
+            return execute(*args, **kwargs)
+        instrumentation.before_execute(sql, params)
+        started = time.perf_counter()
+        error = None
+        try:
+            return execute(*args, **kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            instrumentation.after_execute(
+                sql, params, time.perf_counter() - started, cursor.rowcount, error
+            )
+
+    def _execute(self, sql, params=None, prepare=False):
+        statement_sql = sql
+        registry = self.connection.prepared_statements
+        if prepare and registry is not None:
+            statement = registry.get_statement(self.cursor, sql)
+            if statement is not None:
+                statement_sql = statement[1]
+        if not instrumentation.enabled:
+            self.cursor.execute(statement_sql, params or ())
+        else:
+            self._instrumented(
+                self.cursor,
+                sql,
+                params,
+                self.cursor.execute,
+                statement_sql,
+                params or (),
+            )
 
-    def query(self, sql, params=None):
-        print(self.mogrify(sql, params))
-        self.cursor.execute(sql, params or ())
+    def query(self, sql, params=None, prepare=False):
+        self._execute(sql, params, prepare=prepare)
 
     def mogrify(self, sql, params=None):
         return self.cursor.mogrify(sql, params or ())
@@ -59,21 +473,42 @@ class PostgreSQL:
         return self.cursor.fetchone()
 
     def insert(self, sql, params=None):
-        print(self.mogrify(sql, params))
-        self.cursor.execute(sql, params or ())
+        self._execute(sql, params)
         self.commit()
 
-    def insert_many(self, sql, params=None):
-        params_str = ",".join(
-            (self.mogrify("%s", (x,))).decode("utf-8") for x in params
-        )
-        print(self.mogrify(sql.format(params_str)))
-        self.cursor.execute(sql.format(params_str))
+    def insert_many(self, sql, params=None, page_size=1000):
+        self.execute_values(sql.format("%s"), params or [], page_size=page_size)
         self.commit()
 
-    def fetch_query_results(self, sql, params=None):
-        print(self.mogrify(sql, params))
-        self.cursor.execute(sql, params or ())
+    def execute_values(self, sql, params, page_size=1000, fetch=False, template=None):
+        result = self._instrumented(
+            self.cursor,
+            sql,
+            params,
+            execute_values,
+            self.cursor,
+            sql,
+            params,
+            template=template,
+            page_size=page_size,
+            fetch=fetch,
+        )
+        return result if fetch else self.cursor.rowcount
+
+    def copy_from(self, sql, chunks, size=65536):
+        self._instrumented(
+            self.cursor,
+            sql,
+            None,
+            self.cursor.copy_expert,
+            sql,
+            CopyStream(chunks),
+            size=size,
+        )
+        return self.cursor.rowcount
+
+    def fetch_query_results(self, sql, params=None, prepare=False):
+        self._execute(sql, params, prepare=prepare)
         while True:
             try:
                 results = self.cursor.fetchmany(100)
@@ -83,3 +518,39 @@ class PostgreSQL:
                     yield result
             except psycopg2.ProgrammingError:
                 break
+
+    def stream_query_results(self, sql, params=None, itersize=None):
+        itersize = itersize or ITERATOR_CHUNK_SIZE
+        cursor = self.connection.cursor(
+            name="orm_cursor_{}".format(next(_cursor_names))
+        )
+        cursor.itersize = itersize
+        # A named cursor only knows its row count once the rows are fetched, so
+        # the statement is reported when the stream ends or is closed.
+        instrumented = instrumentation.enabled
+        if instrumented:
+            instrumentation.before_execute(sql, params)
+        started = time.perf_counter()
+        rows = 0
+        error = None
+        try:
+            cursor.execute(sql, params or ())
+            while True:
+                results = cursor.fetchmany(itersize)
+                if not results:
+                    break
+                for result in results:
+                    rows += 1
+                    yield result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            try:
+                cursor.close()
+            except psycopg2.Error:
+                pass
+            if instrumented:
+                instrumentation.after_execute(
+                    sql, params, time.perf_counter() - started, rows, error
+                )
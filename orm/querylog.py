@@ -0,0 +1,112 @@
+import logging
+import os
+import random
+from collections import namedtuple
+
+from orm import instrumentation
+
+logger = logging.getLogger("orm.queries")
+
+QueryRecord = namedtuple(
+    "QueryRecord", ["sql", "param_count", "duration", "rows", "slow", "error"]
+)
+
+
+def _param_count(params):
+    if params is None:
+        return 0
+    try:
+        return len(params)
+    except TypeError:
+        return 0
+
+
+def log_record(record):
+    if record.error is not None:
+        level = logging.ERROR
+    elif record.slow:
+        level = logging.WARNING
+    else:
+        level = logging.DEBUG
+    logger.log(
+        level,
+        "%s (%d params, %d rows, %.2f ms)",
+        record.sql,
+        record.param_count,
+        record.rows,
+        record.duration * 1000,
+        extra={"query": record},
+    )
+
+
+class QueryLogger:
+    """
+    Emits a `QueryRecord` for executed statements. Statements slower than
+    `slow_query_threshold` seconds are always emitted, the rest with
+    probability `sample_rate`. Records go to `handler`, which defaults to
+    the `orm.queries` logger.
+    """
+
+    def __init__(self, sample_rate=1.0, slow_query_threshold=None, handler=None):
+        if not 0 <= sample_rate <= 1:
+            raise ValueError("Invalid sample rate: {}".format(sample_rate))
+        self.sample_rate = sample_rate
+        self.slow_query_threshold = slow_query_threshold
+        self.handler = handler or log_record
+
+    def record(self, sql, params, duration, rows, error=None):
+        threshold = self.slow_query_threshold
+        slow = threshold is not None and duration >= threshold
+        if not slow and error is None:
+            if self.sample_rate < 1 and random.random() >= self.sample_rate:
+                return
+        if isinstance(sql, bytes):
+            sql = sql.decode("utf-8", "replace")
+        self.handler(
+            QueryRecord(
+                sql=sql,
+                param_count=_param_count(params),
+                duration=duration,
+                rows=rows,
+                slow=slow,
+                error=error,
+            )
+        )
+
+
+def _settings_from_env():
+    if os.getenv("DB_QUERY_LOG", "").lower() not in ("1", "true", "yes", "on"):
+        return None
+    threshold = os.getenv("DB_SLOW_QUERY_THRESHOLD")
+    return QueryLogger(
+        sample_rate=float(os.getenv("DB_QUERY_LOG_SAMPLE_RATE") or 1),
+        slow_query_threshold=float(threshold) if threshold else None,
+    )
+
+
+def _set_query_logger(new_logger):
+    global query_logger
+    if query_logger is not None:
+        instrumentation.unregister_hook("after_execute", query_logger.record)
+    query_logger = new_logger
+    if query_logger is not None:
+        instrumentation.register_hook("after_execute", query_logger.record)
+    return query_logger
+
+
+query_logger = None
+_set_query_logger(_settings_from_env())
+
+
+def configure_query_logging(
+    enabled=True, sample_rate=1.0, slow_query_threshold=None, handler=None
+):
+    return _set_query_logger(
+        QueryLogger(
+            sample_rate=sample_rate,
+            slow_query_threshold=slow_query_threshold,
+            handler=handler,
+        )
+        if enabled
+        else None
+    )
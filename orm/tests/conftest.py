@@ -3,6 +3,7 @@ import datetime
 import pytest
 from faker import Faker
 
+from orm import cache, querylog
 from orm.database import Table
 from orm.fields import (
     BooleanField,
@@ -45,7 +46,7 @@ def create_user():
                 users.append(
                     dict(
                         name=kwargs.get("name", data["name"]),
-                        username=kwargs.get("username", data["username"]),
+                        username=kwargs.get("username", fake.unique.user_name()),
                         sex=kwargs.get("sex", data["sex"]),
                         address=kwargs.get("address", data["address"]),
                         age=kwargs.get(
@@ -57,7 +58,7 @@ def create_user():
         data = fake.simple_profile()
         return TestUser.objects.create(
             name=kwargs.get("name", data["name"]),
-            username=kwargs.get("username", data["username"]),
+            username=kwargs.get("username", fake.unique.user_name()),
             sex=kwargs.get("sex", data["sex"]),
             address=kwargs.get("address", data["address"]),
             age=kwargs.get(
@@ -94,6 +95,25 @@ def create_company():
     return inner
 
 
+@pytest.fixture
+def captured_queries(monkeypatch):
+    queries = []
+    original_query = PostgreSQL.query
+
+    def query(self, sql, params=None, **kwargs):
+        queries.append(sql)
+        return original_query(self, sql, params, **kwargs)
+
+    def fetch_query_results(self, sql, params=None, **kwargs):
+        queries.append(sql)
+        return original_fetch_query_results(self, sql, params, **kwargs)
+
+    original_fetch_query_results = PostgreSQL.fetch_query_results
+    monkeypatch.setattr(PostgreSQL, "query", query)
+    monkeypatch.setattr(PostgreSQL, "fetch_query_results", fetch_query_results)
+    return queries
+
+
 @pytest.fixture(autouse=True)
 def migrate_db():
     query = """
@@ -124,3 +144,20 @@ def reset_db():
         for query in queries:
             pgsql.query(query, [])
             pgsql.commit()
+
+
+@pytest.fixture
+def query_records():
+    records = []
+    querylog.configure_query_logging(handler=records.append)
+    yield records
+    querylog.configure_query_logging(enabled=False)
+
+
+@pytest.fixture
+def result_cache(monkeypatch):
+    backend = cache.MemoryCacheBackend()
+    monkeypatch.setattr(cache, "backend", backend)
+    monkeypatch.setattr(TestUser._meta, "cache", True)
+    monkeypatch.setattr(TestCompany._meta, "cache", True)
+    return backend
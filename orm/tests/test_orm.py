@@ -1,5 +1,29 @@
+import asyncio
+import pickle
+import threading
+import time
+import timeit
+import tracemalloc
+
+import psycopg2
 import pytest
 from psycopg2.errors import NotNullViolation
+from psycopg2.extensions import STATUS_READY, TRANSACTION_STATUS_IDLE
+
+from orm import cache, instrumentation, querylog
+from orm.aio import AsyncConnectionPool, AsyncPostgreSQL, configure_async_pool
+from orm.commands import CompiledQueryCache, compiled_query_cache
+from orm.database import ObjectDoesNotExist, QueryException, SQLException, Table
+from orm.fields import CharField, DefaultPrimaryKeyField, ForeignKeyField
+from orm.identity import get_identity_map, identity_map
+from orm.postgres import (
+    ConnectionPool,
+    PoolTimeoutException,
+    PostgreSQL,
+    configure_pool,
+    get_pool,
+)
+from orm.transaction import atomic, in_atomic_block
 
 from .conftest import TestCompany, TestUser
 
@@ -75,7 +99,7 @@ class TestORM:
         create_user(bulk_create=9)
         users = TestUser.objects.filter(name__contains="Charlesx")
         first_filter = [x for x in users]
-        users.filter(age=10)
+        users = users.filter(age=10)
         second_filter = [x for x in users]
         assert TestUser.objects.all().count() == 12
         assert len(first_filter) == 2
@@ -96,3 +120,1393 @@ class TestORM:
         user.name = "Charles Oraegbu"
         user.save()
         assert TestUser.objects.filter(name="Charles Oraegbu").count() == 1
+
+
+class TestConnectionPool:
+    def test_connection_is_reused(self):
+        pool = ConnectionPool(min_size=0, max_size=2)
+        with PostgreSQL(pool=pool) as pgsql:
+            first = pgsql.connection
+        with PostgreSQL(pool=pool) as pgsql:
+            assert pgsql.connection is first
+        assert pool.size == 1
+        pool.closeall()
+
+    def test_checkout_timeout(self):
+        pool = ConnectionPool(min_size=1, max_size=1, timeout=0.1)
+        conn = pool.getconn()
+        with pytest.raises(PoolTimeoutException):
+            pool.getconn()
+        pool.putconn(conn)
+        assert pool.getconn() is conn
+        pool.closeall()
+
+    def test_broken_connection_is_replaced(self):
+        pool = ConnectionPool(min_size=1, max_size=1)
+        conn = pool.getconn()
+        pool.putconn(conn)
+        conn.close()
+        new_conn = pool.getconn()
+        assert new_conn is not conn
+        assert not new_conn.closed
+        pool.putconn(new_conn)
+        pool.closeall()
+
+    def test_uncommitted_work_is_rolled_back_on_return(self):
+        pool = ConnectionPool(min_size=0, max_size=1)
+        with PostgreSQL(pool=pool) as pgsql:
+            pgsql.query("SELECT 1")
+        conn = pool.getconn()
+        assert conn.info.transaction_status == TRANSACTION_STATUS_IDLE
+        pool.putconn(conn)
+        pool.closeall()
+
+    def test_threads_share_bounded_pool(self):
+        pool = ConnectionPool(min_size=0, max_size=3)
+        results = []
+
+        def worker():
+            with PostgreSQL(pool=pool) as pgsql:
+                pgsql.query("SELECT pg_sleep(0.05), 1")
+                results.append(pgsql.fetchone()[1])
+
+        threads = [threading.Thread(target=worker) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert results == [1] * 8
+        assert pool.size <= 3
+        pool.closeall()
+
+
+class TestTableMetadata:
+    def test_metadata_compiled_at_class_definition(self):
+        meta = TestCompany._meta
+        assert meta.column_names == ("active", "catch_phrase", "id", "name", "owner")
+        assert meta.pk_name == "id"
+        assert meta.fk_targets == {"owner": TestUser}
+        assert meta.quoted_columns["owner"] == '"owner"'
+        assert TestCompany.get_column_names() == list(meta.column_names)
+
+    def test_hot_path_does_not_query_catalog(self, create_user, captured_queries):
+        user = create_user()
+        TestUser.objects.get(id=user.id).save()
+        assert not [sql for sql in captured_queries if "information_schema" in sql]
+
+    def test_reconcile_columns(self):
+        assert TestUser.reconcile_columns(strict=True) == {
+            "missing": [],
+            "unexpected": [],
+        }
+
+
+class TestIterator:
+    def test_iterator_streams_all_rows(self, create_user):
+        create_user(bulk_create=7)
+        users = [u for u in TestUser.objects.all().iterator(chunk_size=2)]
+        assert len(users) == 7
+        assert all(isinstance(u, TestUser) for u in users)
+
+    def test_abandoned_iterator_releases_connection(self, create_user):
+        create_user(bulk_create=5)
+        pool = get_pool()
+        idle = pool.idle
+        rows = TestUser.objects.all().iterator(chunk_size=2)
+        next(rows)
+        assert pool.idle == idle - 1
+        rows.close()
+        assert pool.idle == idle
+        conn = pool.getconn()
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM pg_cursors")
+            assert cursor.fetchone()[0] == 0
+        pool.putconn(conn)
+
+
+class TestBulkCreate:
+    @staticmethod
+    def users(count):
+        for i in range(count):
+            yield dict(
+                name="User\t{}\\n".format(i),
+                username="user{}".format(i),
+                sex="M",
+                address="Line 1\nLine 2",
+                age=i,
+            )
+
+    def test_copy_text_in_batches(self):
+        assert TestUser.objects.bulk_create(self.users(25), batch_size=10) == 25
+        user = TestUser.objects.get(username="user3")
+        assert user.name == "User\t3\\n"
+        assert user.address == "Line 1\nLine 2"
+        assert user.age == 3
+
+    def test_copy_binary(self, create_user):
+        owner = create_user()
+        companies = [
+            TestCompany(owner=owner, name="Company {}".format(i), active=i % 2 == 0)
+            for i in range(4)
+        ]
+        companies.append(
+            dict(owner=owner.id, name="Nullable", catch_phrase=None, active=True)
+        )
+        created = TestCompany.objects.bulk_create(companies, copy_format="binary")
+        assert created == 5
+        assert TestCompany.objects.filter(active=True).count() == 3
+        assert TestCompany.objects.filter(owner__id=owner.id).count() == 5
+
+    def test_insert_returning_pks(self):
+        users = [TestUser(**data) for data in self.users(5)]
+        pks = TestUser.objects.bulk_create(users, batch_size=2, returning=True)
+        assert len(pks) == 5
+        assert [u.id for u in users] == pks
+        assert TestUser.objects.get(id=pks[4]).username == "user4"
+
+    def test_returning_requires_insert(self):
+        with pytest.raises(QueryException):
+            TestUser.objects.bulk_create([], method="copy", returning=True)
+
+
+class TestCountExists:
+    def test_count_uses_sql(self, create_user, captured_queries):
+        create_user(bulk_create=4)
+        create_user(name="Counted", age=99)
+        assert TestUser.objects.filter(age=99).count() == 1
+        assert captured_queries[-1].startswith("SELECT COUNT(*) FROM")
+
+    def test_count_over_fk_and_exclude(self, create_company, create_user):
+        user = create_user()
+        other = create_user()
+        create_company(owner=user.id, bulk_create=3, active=True)
+        create_company(owner=other.id, bulk_create=2, active=False)
+        assert TestCompany.objects.filter(owner__id=user.id).count() == 3
+        assert TestCompany.objects.exclude(active=True).count() == 2
+
+    def test_count_of_slice(self, create_user):
+        create_user(bulk_create=5)
+        users = TestUser.objects.all()[1:3]
+        assert users.count() == 2
+
+    def test_exists(self, create_user, captured_queries):
+        create_user(name="Exists")
+        assert TestUser.objects.filter(name="Exists").exists()
+        assert not TestUser.objects.filter(name="Missing").exists()
+        assert captured_queries[-1].endswith("LIMIT 1;")
+
+
+class TestCompiledQueryCache:
+    def test_same_shape_reuses_compiled_sql(self, create_user):
+        create_user(name="First", age=1)
+        create_user(name="Second", age=2)
+        compiled_query_cache.clear()
+        assert TestUser.objects.get(name="First").age == 1
+        assert TestUser.objects.get(name="Second").age == 2
+        info = compiled_query_cache.info()
+        assert info["misses"] == 1
+        assert info["hits"] == 1
+
+    def test_value_dependent_sql_is_not_shared(self, create_company, create_user):
+        user = create_user()
+        create_company(owner=user.id, bulk_create=2)
+        TestCompany.objects.create(owner=user.id, name="Null", active=True)
+        assert TestCompany.objects.filter(catch_phrase__isnull=True).count() == 1
+        assert TestCompany.objects.filter(catch_phrase__isnull=False).count() == 2
+
+    def test_slices_share_shape(self, create_user):
+        create_user(bulk_create=5)
+        compiled_query_cache.clear()
+        first = list(TestUser.objects.all()[1:3])
+        second = list(TestUser.objects.all()[2:5])
+        assert len(first) == 2
+        assert len(second) == 3
+        assert compiled_query_cache.info()["hits"] == 1
+
+    def test_lru_eviction(self):
+        cache = CompiledQueryCache(maxsize=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+        assert cache.get("b") is None
+        assert cache.get("a") == 1
+        assert cache.info()["size"] == 2
+
+
+class TestPreparedStatements:
+    @staticmethod
+    def prepared_statements(pgsql):
+        pgsql.query("SELECT name FROM pg_prepared_statements")
+        return [i[0] for i in pgsql.fetchall()]
+
+    def test_prepared_after_threshold(self):
+        pool = ConnectionPool(min_size=0, max_size=1, prepare_threshold=2)
+        sql = "SELECT %s + 1, '100%%';"
+        with PostgreSQL(pool=pool) as pgsql:
+            pgsql.query(sql, [1], prepare=True)
+            assert pgsql.fetchone() == (2, "100%")
+            assert self.prepared_statements(pgsql) == []
+            pgsql.query(sql, [2], prepare=True)
+            assert pgsql.fetchone() == (3, "100%")
+            assert sql in pgsql.connection.prepared_statements
+        with PostgreSQL(pool=pool) as pgsql:
+            pgsql.query(sql, [3], prepare=True)
+            assert pgsql.fetchone() == (4, "100%")
+            assert len(self.prepared_statements(pgsql)) == 1
+        pool.closeall()
+
+    def test_least_recently_used_statement_is_deallocated(self):
+        pool = ConnectionPool(
+            min_size=0, max_size=1, prepare_threshold=1, max_prepared_statements=1
+        )
+        with PostgreSQL(pool=pool) as pgsql:
+            pgsql.query("SELECT %s;", [1], prepare=True)
+            pgsql.query("SELECT %s + 0, %s + 0;", [1, 2], prepare=True)
+            assert pgsql.fetchone() == (1, 2)
+            assert len(self.prepared_statements(pgsql)) == 1
+            assert "SELECT %s + 0, %s + 0;" in pgsql.connection.prepared_statements
+        pool.closeall()
+
+    def test_orm_lookups_use_prepared_statements(self, create_company, create_user):
+        user = create_user()
+        create_company(owner=user.id, bulk_create=2)
+        configure_pool(prepare_threshold=1)
+        try:
+            for _ in range(3):
+                assert TestUser.objects.get(pk=user.id).id == user.id
+                assert TestCompany.objects.filter(owner__in=[user.id]).count() == 2
+            with PostgreSQL() as pgsql:
+                assert len(self.prepared_statements(pgsql)) == 2
+        finally:
+            configure_pool()
+
+
+class TestHydration:
+    def test_select_related_hydrates_nested_instance(
+        self, create_company, create_user, captured_queries
+    ):
+        user = create_user(name="Owner")
+        create_company(owner=user.id, company="Acme")
+        company = TestCompany.objects.select_related("owner").get(name="Acme")
+        queries = len(captured_queries)
+        assert isinstance(company.owner, TestUser)
+        assert company.owner.name == "Owner"
+        assert company.owner.id == user.id
+        assert company.name == "Acme"
+        assert len(captured_queries) == queries
+
+    def test_unjoined_foreign_key_is_bound_field(self, create_company, create_user):
+        user = create_user(name="Lazy")
+        create_company(owner=user.id, bulk_create=2)
+        companies = list(TestCompany.objects.all())
+        assert isinstance(companies[0].owner, ForeignKeyField)
+        assert companies[0].owner.get_value() == user.id
+        assert companies[1].owner.get_value() == user.id
+        assert companies[0].owner is not companies[1].owner
+        assert companies[0].owner.name == "Lazy"
+
+    def test_select_related_validates_path(self):
+        with pytest.raises(QueryException):
+            TestCompany.objects.select_related("name")
+
+
+class TestCompactRows:
+    row = ("Lagos, Nigeria", 40, 1, "Charles", "M", "charles")
+
+    def build_rows(self, table_class, count):
+        names = TestUser._meta.column_names
+        return [table_class._from_db(names, self.row) for _ in range(count)]
+
+    def test_memory_per_100k_rows(self):
+        usage = {}
+        for table_class in (TestUser, TestUser.compact_class()):
+            tracemalloc.start()
+            rows = self.build_rows(table_class, 100000)
+            usage[table_class], _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del rows
+        assert usage[TestUser.compact_class()] < usage[TestUser] * 0.8
+
+    def test_attribute_access_is_faster(self):
+        regular, compact = [
+            self.build_rows(table_class, 1)[0]
+            for table_class in (TestUser, TestUser.compact_class())
+        ]
+        regular_time = min(timeit.repeat(lambda: regular.name, number=20000))
+        compact_time = min(timeit.repeat(lambda: compact.name, number=20000))
+        assert compact_time < regular_time
+
+    def test_compact_rows_keep_table_api(self, create_user):
+        user = create_user(name="Compact", age=30)
+        row = TestUser.compact_class().objects.get(id=user.id)
+        assert isinstance(row, TestUser)
+        assert not hasattr(row, "__dict__") or not row.__dict__
+        assert row.pk == user.id
+        assert row.as_dict()["name"] == "Compact"
+        row.age = 31
+        row.save()
+        assert TestUser.objects.get(id=user.id).age == 31
+        assert pickle.loads(pickle.dumps(row)).as_dict() == row.as_dict()
+        row.delete()
+        assert not TestUser.objects.filter(id=user.id).exists()
+
+
+class TestValues:
+    @pytest.fixture
+    def companies(self, create_company, create_user):
+        first = create_user(name="First Owner", age=30)
+        second = create_user(name="Second Owner", age=40)
+        create_company(owner=first.id, company="Alpha", active=True)
+        create_company(owner=second.id, company="Beta", active=False)
+        create_company(owner=second.id, company="Gamma", active=True)
+        return first, second
+
+    def test_values(self, companies):
+        rows = list(TestCompany.objects.order_by("name").values("name", "active"))
+        assert rows == [
+            {"name": "Alpha", "active": True},
+            {"name": "Beta", "active": False},
+            {"name": "Gamma", "active": True},
+        ]
+
+    def test_values_list_across_foreign_key(self, companies):
+        rows = (
+            TestCompany.objects.filter(active=True)
+            .order_by("-name")
+            .values_list("name", "owner__name")
+        )
+        assert list(rows) == [("Gamma", "Second Owner"), ("Alpha", "First Owner")]
+
+    def test_values_list_flat_and_slicing(self, companies):
+        names = TestCompany.objects.exclude(name="Beta").order_by("name")
+        assert list(names.values_list("name", flat=True)[0:1]) == ["Alpha"]
+        assert TestCompany.objects.values_list("pk", flat=True).count() == 3
+
+    def test_values_list_named(self, companies):
+        first, _ = companies
+        row = TestCompany.objects.values_list("owner", "owner__age", named=True).get(
+            name="Alpha"
+        )
+        assert row.owner == first.id
+        assert row.owner__age == 30
+
+    def test_values_rejects_unknown_fields(self):
+        with pytest.raises(QueryException):
+            TestCompany.objects.values("owner__missing")
+        with pytest.raises(QueryException):
+            TestCompany.objects.values_list("name", "active", flat=True)
+
+
+class TestPrefetchRelated:
+    def test_one_query_per_relation(
+        self, create_company, create_user, captured_queries
+    ):
+        owners = [create_user(name="Owner {}".format(i)) for i in range(3)]
+        for owner in owners:
+            create_company(owner=owner.id, bulk_create=4)
+        del captured_queries[:]
+        companies = list(TestCompany.objects.prefetch_related("owner"))
+        assert len(captured_queries) == 2
+        assert "ANY(%s)" in captured_queries[1]
+        assert len(companies) == 12
+        names = {c.owner.name for c in companies}
+        assert names == {"Owner 0", "Owner 1", "Owner 2"}
+        assert len(captured_queries) == 2
+        same_owner = [c.owner for c in companies if c.owner.id == owners[0].id]
+        assert all(owner is same_owner[0] for owner in same_owner)
+
+    def test_prefetch_per_chunk(self, create_company, create_user, captured_queries):
+        owner = create_user()
+        create_company(owner=owner.id, bulk_create=5)
+        del captured_queries[:]
+        companies = list(
+            TestCompany.objects.prefetch_related("owner").iterator(chunk_size=2)
+        )
+        assert len(companies) == 5
+        assert all(c.owner.id == owner.id for c in companies)
+        assert len(captured_queries) == 3
+
+    def test_prefetch_validates_path(self):
+        with pytest.raises(QueryException):
+            TestCompany.objects.prefetch_related("owner__name")
+
+
+class TestForeignKeyCache:
+    def test_related_object_loaded_once(
+        self, create_company, create_user, captured_queries
+    ):
+        user = create_user(name="Cached", address="Somewhere")
+        create_company(owner=user.id)
+        company = TestCompany.objects.all()[0]
+        del captured_queries[:]
+        assert company.owner.name + company.owner.address == "CachedSomewhere"
+        assert len(captured_queries) == 1
+
+    def test_reassigned_value_invalidates_cache(self, create_company, create_user):
+        first = create_user(name="First")
+        second = create_user(name="Second")
+        create_company(owner=first.id)
+        company = TestCompany.objects.all()[0]
+        assert company.owner.name == "First"
+        company.owner.set_value(second.id)
+        assert company.owner.name == "Second"
+
+    def test_refresh_from_db(self, create_company, create_user, captured_queries):
+        user = create_user(name="Before")
+        create_company(owner=user.id, company="Refresh")
+        company = TestCompany.objects.all()[0]
+        assert company.owner.name == "Before"
+        user.name = "After"
+        user.save()
+        assert company.owner.name == "Before"
+        assert company.owner.refresh_from_db().name == "After"
+        assert company.owner.name == "After"
+
+        company.name = "Changed locally"
+        company.refresh_from_db()
+        assert company.name == "Refresh"
+
+    def test_dunder_lookup_does_not_query(self, create_company, create_user):
+        user = create_user()
+        create_company(owner=user.id)
+        owner = TestCompany.objects.all()[0].owner
+        assert not hasattr(owner, "__missing__")
+        assert pickle.loads(pickle.dumps(owner)).get_value() == user.id
+
+
+class TestDirtyFields:
+    def test_unchanged_row_skips_update(self, create_user, captured_queries):
+        create_user(name="Clean")
+        user = TestUser.objects.get(name="Clean")
+        del captured_queries[:]
+        assert user.get_dirty_fields() == []
+        user.save()
+        assert captured_queries == []
+
+    def test_only_changed_columns_are_updated(self, create_user, captured_queries):
+        create_user(name="Dirty", age=10)
+        user = TestUser.objects.get(name="Dirty")
+        user.name = "Changed"
+        assert user.get_dirty_fields() == ["name"]
+        del captured_queries[:]
+        user.save()
+        assert len(captured_queries) == 1
+        assert '"name"=%s' in captured_queries[0]
+        assert '"age"' not in captured_queries[0]
+        assert user.get_dirty_fields() == []
+        assert TestUser.objects.get(id=user.id).name == "Changed"
+
+    def test_update_fields(self, create_user, captured_queries):
+        create_user(name="Partial", age=10)
+        user = TestUser.objects.get(name="Partial")
+        user.name = "Saved"
+        user.age = 20
+        del captured_queries[:]
+        user.save(update_fields=["age"])
+        assert '"name"' not in captured_queries[0]
+        saved = TestUser.objects.get(id=user.id)
+        assert (saved.name, saved.age) == ("Partial", 20)
+        assert user.get_dirty_fields() == ["name"]
+        with pytest.raises(SQLException):
+            user.save(update_fields=["missing"])
+
+    def test_new_instance_saves_all_columns(self, create_user):
+        user = create_user(name="Fresh")
+        assert user.get_dirty_fields() == []
+        user.age = 30
+        assert user.get_dirty_fields() == ["age"]
+
+    def test_foreign_key_change_is_dirty(self, create_company, create_user):
+        first = create_user(name="First")
+        second = create_user(name="Second")
+        create_company(owner=first.id)
+        company = TestCompany.objects.all()[0]
+        company.owner.set_value(second.id)
+        assert company.get_dirty_fields() == ["owner"]
+        company.save()
+        assert TestCompany.objects.all()[0].owner.get_value() == second.id
+
+    def test_compact_rows_track_changes(self, create_user):
+        create_user(name="Compact")
+        TestUser._meta.compact = True
+        try:
+            user = TestUser.objects.get(name="Compact")
+            user.name = "Slotted"
+            assert user.get_dirty_fields() == ["name"]
+            user.save()
+            assert pickle.loads(pickle.dumps(user)).get_dirty_fields() == []
+        finally:
+            TestUser._meta.compact = False
+
+
+class TestBulkUpdate:
+    def test_bulk_update(self, create_user):
+        create_user(bulk_create=5, age=10)
+        users = list(TestUser.objects.all())
+        for i, user in enumerate(users):
+            user.age = 20 + i
+            user.name = "Unsaved"
+        assert TestUser.objects.bulk_update(users, ["age"], batch_size=2) == 5
+        saved = {i.id: i for i in TestUser.objects.all()}
+        for i, user in enumerate(users):
+            assert saved[user.id].age == 20 + i
+            assert saved[user.id].name != "Unsaved"
+            assert user.get_dirty_fields() == ["name"]
+
+    def test_bulk_update_generator(self, create_user):
+        create_user(bulk_create=3, age=10)
+        users = list(TestUser.objects.all())
+        for user in users:
+            user.age = 30
+        assert TestUser.objects.bulk_update((i for i in users), ["age"]) == 3
+        assert all(i.get_dirty_fields() == [] for i in users)
+
+    def test_bulk_update_nulls_and_dicts(self, create_user):
+        user = create_user(name="Nullable")
+        TestUser.objects.bulk_update([{"id": user.id, "name": None}], ["name"])
+        assert TestUser.objects.get(id=user.id).name is None
+
+    def test_bulk_update_validation(self, create_user):
+        user = create_user()
+        with pytest.raises(QueryException):
+            TestUser.objects.bulk_update([user], ["missing"])
+        with pytest.raises(QueryException):
+            TestUser.objects.bulk_update([user], ["id"])
+        with pytest.raises(QueryException):
+            TestUser.objects.bulk_update([TestUser(name="New")], ["name"])
+
+    def test_bulk_upsert(self, create_user):
+        create_user(username="existing", name="Old", age=10)
+        rows = [
+            dict(username="existing", name="New", sex="m", address="Here", age=11),
+            dict(username="fresh", name="Fresh", sex="f", address="There", age=12),
+        ]
+        assert TestUser.objects.bulk_upsert(rows, conflict_target="username") == 2
+        assert TestUser.objects.count() == 2
+        existing = TestUser.objects.get(username="existing")
+        assert (existing.name, existing.age) == ("New", 11)
+
+        rows[0]["name"] = "Ignored"
+        rows[0]["age"] = 99
+        TestUser.objects.bulk_upsert(
+            rows, conflict_target=["username"], update_fields=["age"], batch_size=1
+        )
+        existing = TestUser.objects.get(username="existing")
+        assert (existing.name, existing.age) == ("New", 99)
+
+    def test_bulk_upsert_do_nothing(self, create_user):
+        create_user(username="kept", name="Kept")
+        row = dict(username="kept", name="Other", sex="m", address="Here", age=1)
+        TestUser.objects.bulk_upsert([row], "username", update_fields=[])
+        assert TestUser.objects.get(username="kept").name == "Kept"
+
+
+class TestAtomic:
+    def test_commits_once_at_the_end(self):
+        with atomic():
+            assert in_atomic_block()
+            for i in range(3):
+                TestUser(
+                    name="Atomic",
+                    username="atomic{}".format(i),
+                    sex="m",
+                    address="A",
+                    age=i,
+                ).save()
+            with PostgreSQL() as first, PostgreSQL() as second:
+                assert first.connection is second.connection
+                assert first.connection.status != STATUS_READY
+        assert not in_atomic_block()
+        assert TestUser.objects.filter(name="Atomic").count() == 3
+
+    def test_rolls_back_on_error(self, create_user):
+        user = create_user(name="Kept")
+        with pytest.raises(ValueError):
+            with atomic():
+                TestUser(
+                    name="Lost", username="lost", sex="m", address="A", age=1
+                ).save()
+                TestUser.objects.filter(id=user.id).delete()
+                raise ValueError
+        assert TestUser.objects.count() == 1
+        assert TestUser.objects.get(id=user.id).name == "Kept"
+
+    def test_nested_savepoint(self):
+        with atomic():
+            TestUser(name="Outer", username="outer", sex="m", address="A", age=1).save()
+            with pytest.raises(NotNullViolation):
+                with atomic():
+                    TestUser(
+                        name="Inner", username="inner", sex="m", address="A", age=1
+                    ).save()
+                    TestUser(
+                        name="Broken", username="broken", sex="m", address="A"
+                    ).save()
+            with atomic():
+                TestUser(
+                    name="Second", username="second", sex="m", address="A", age=1
+                ).save()
+        assert sorted(i.name for i in TestUser.objects.all()) == ["Outer", "Second"]
+
+    def test_decorator(self):
+        @atomic
+        def create(fail):
+            TestUser(
+                name="Decorated", username="decorated", sex="m", address="A", age=1
+            ).save()
+            if fail:
+                raise ValueError
+
+        with pytest.raises(ValueError):
+            create(True)
+        assert not TestUser.objects.filter(name="Decorated").exists()
+        create(False)
+        assert TestUser.objects.filter(name="Decorated").exists()
+
+    def test_connection_is_bound_per_thread(self):
+        seen = []
+        with atomic():
+            with PostgreSQL() as pgsql:
+                conn = pgsql.connection
+            thread = threading.Thread(target=lambda: seen.append(in_atomic_block()))
+            thread.start()
+            thread.join()
+            with PostgreSQL() as pgsql:
+                assert pgsql.connection is conn
+        assert seen == [False]
+
+    def test_retry_after_rollback(self, create_user):
+        user = create_user(name="Before")
+        user.name = "Changed"
+        with pytest.raises(ValueError):
+            with atomic():
+                user.save()
+                raise ValueError
+        assert user.get_dirty_fields() == ["name"]
+        user.save()
+        assert TestUser.objects.get(id=user.id).name == "Changed"
+
+        new = TestUser(name="New", username="retried", sex="m", address="A", age=1)
+        with pytest.raises(ValueError):
+            with atomic():
+                new.save()
+                assert new.id is not None
+                raise ValueError
+        assert new.id is None
+        new.save()
+        assert TestUser.objects.get(username="retried").id == new.id
+
+    def test_savepoint_rollback_restores_save_state(self, create_user):
+        user = create_user(age=10)
+        with atomic():
+            user.age = 11
+            user.save()
+            with pytest.raises(ValueError):
+                with atomic():
+                    user.age = 12
+                    TestUser.objects.bulk_update([user], ["age"])
+                    raise ValueError
+            assert user.get_dirty_fields() == ["age"]
+            user.save()
+        assert TestUser.objects.get(id=user.id).age == 12
+
+    def test_commit_flag_requires_atomic_block(self):
+        user = TestUser(
+            name="Uncommitted", username="uncommitted", sex="m", address="A", age=1
+        )
+        with pytest.raises(SQLException):
+            user.save(commit=False)
+        assert user.id is None
+        assert user.get_dirty_fields() == list(TestUser._meta.non_pk_columns)
+        assert not TestUser.objects.filter(username="uncommitted").exists()
+        with atomic():
+            user.save(commit=False)
+        assert TestUser.objects.filter(id=user.id).exists()
+
+
+class TestKeysetPagination:
+    def test_iter_pages(self, create_user, captured_queries):
+        create_user(bulk_create=25)
+        expected = [i.id for i in TestUser.objects.order_by("id")]
+        del captured_queries[:]
+        pages = list(TestUser.objects.all().iter_pages(page_size=10))
+        assert [len(i) for i in pages] == [10, 10, 5]
+        assert [i.id for page in pages for i in page] == expected
+        assert "OFFSET" not in captured_queries[-1]
+        assert "(table_0.id) > (%s)" in captured_queries[-1]
+
+    def test_paginate_after(self, create_user):
+        create_user(bulk_create=5)
+        users = list(TestUser.objects.order_by("id"))
+        page = TestUser.objects.all().paginate_after(users[1].id, page_size=2)
+        assert [i.id for i in page] == [users[2].id, users[3].id]
+        page = TestUser.objects.all().paginate_after(users[1], page_size=10)
+        assert [i.id for i in page] == [i.id for i in users[2:]]
+
+    def test_descending_order(self, create_user):
+        create_user(bulk_create=12, age=10)
+        create_user(bulk_create=3, age=20)
+        expected = [i.id for i in TestUser.objects.order_by(["-age", "-id"])]
+        pages = TestUser.objects.order_by("-age").iter_pages(page_size=4)
+        assert [i.id for page in pages for i in page] == expected
+
+    def test_mixed_directions(self, create_user, captured_queries):
+        for age in (10, 20, 30):
+            create_user(bulk_create=4, age=age)
+        expected = [i.id for i in TestUser.objects.order_by(["age", "-name", "-id"])]
+        del captured_queries[:]
+        pages = (
+            TestUser.objects.filter(age__gte=10)
+            .order_by(["age", "-name"])
+            .iter_pages(page_size=5)
+        )
+        assert [i.id for page in pages for i in page] == expected
+        assert " OR " in captured_queries[-1]
+
+    def test_values_pages(self, create_user):
+        create_user(bulk_create=5)
+        expected = [i["id"] for i in TestUser.objects.values("id", "name")]
+        pages = TestUser.objects.values("id", "name").iter_pages(page_size=2)
+        assert [i["id"] for page in pages for i in page] == sorted(expected)
+
+    def test_wrong_number_of_values(self):
+        with pytest.raises(QueryException):
+            TestUser.objects.order_by("age").paginate_after(10)
+
+    def test_nullable_order_column(self, create_user):
+        for name in ("B", None, "A", None, "B", None):
+            create_user(name=name, age=10)
+        for order in (["name"], ["-name"], ["age", "-name"], ["-age", "name"]):
+            tie_breaker = "-id" if order[-1].startswith("-") else "id"
+            expected = [i.id for i in TestUser.objects.order_by(order + [tie_breaker])]
+            pages = TestUser.objects.order_by(order).iter_pages(page_size=2)
+            assert [i.id for page in pages for i in page] == expected
+        users = list(TestUser.objects.order_by(["name", "id"]))
+        page = TestUser.objects.order_by("name").paginate_after(users[3], page_size=5)
+        assert [i.id for i in page] == [i.id for i in users[4:]]
+
+    def test_values_list_pages(self, create_user):
+        create_user(bulk_create=10)
+        users = TestUser.objects.order_by("age")
+        expected = list(users.values_list("id", "age").order_by(["age", "id"]))
+        pages = users.values_list("id", "age").iter_pages(page_size=3)
+        assert [i for page in pages for i in page] == expected
+        pages = users.values_list("age", "pk", named=True).iter_pages(page_size=3)
+        assert [(i.pk, i.age) for page in pages for i in page] == expected
+        ids = TestUser.objects.values_list("id", flat=True)
+        pages = ids.iter_pages(page_size=3)
+        assert [i for page in pages for i in page] == sorted(i for i, _ in expected)
+
+    def test_values_list_without_keyset_columns(self, create_user):
+        create_user(bulk_create=4)
+        names = TestUser.objects.order_by("age").values_list("name", "age")
+        with pytest.raises(QueryException):
+            list(names.iter_pages(page_size=2))
+        with pytest.raises(QueryException):
+            list(
+                TestUser.objects.values_list("name", flat=True).iter_pages(page_size=2)
+            )
+
+    def test_custom_primary_key(self):
+        class TestTag(Table):
+            code = DefaultPrimaryKeyField()
+            label = CharField(max_length=255)
+
+        TestTag.migrate()
+        try:
+            TestTag.objects.bulk_create([dict(label=str(i)) for i in range(5)])
+            pages = list(TestTag.objects.all().iter_pages(page_size=2))
+            assert [len(i) for i in pages] == [2, 2, 1]
+            labels = [i.label for page in pages for i in page]
+            assert labels == [str(i) for i in range(5)]
+        finally:
+            with PostgreSQL() as pgsql:
+                pgsql.query("DROP TABLE {};".format(TestTag.get_full_table_name()))
+                pgsql.commit()
+
+
+def count_rows(rows):
+    return sum(1 for _ in rows)
+
+
+class TestParallelScan:
+    def test_parallel_iter(self, create_user):
+        create_user(bulk_create=50, age=10)
+        create_user(bulk_create=10, age=20)
+        users = TestUser.objects.filter(age=10)
+        expected = sorted(i.id for i in TestUser.objects.filter(age=10))
+        found = list(users.parallel_iter(workers=2, partitions=7, chunk_size=5))
+        assert sorted(i.id for i in found) == expected
+        assert all(isinstance(i, TestUser) and i.age == 10 for i in found)
+
+    def test_parallel_iter_values(self, create_user):
+        create_user(bulk_create=20)
+        names = sorted(TestUser.objects.values_list("name", flat=True))
+        found = TestUser.objects.values_list("name", flat=True).parallel_iter(workers=2)
+        assert sorted(found) == names
+
+    def test_map_partitions(self, create_user):
+        create_user(bulk_create=30)
+        counts = TestUser.objects.all().map_partitions(count_rows, workers=3)
+        assert len(counts) == 3
+        assert sum(counts) == 30
+
+    def test_related_partitions(self, create_company, create_user):
+        user = create_user(name="Owner")
+        create_company(bulk_create=10, owner=user.id)
+        companies = TestCompany.objects.select_related("owner").parallel_iter(workers=2)
+        assert [i.owner.name for i in companies] == ["Owner"] * 10
+
+    def test_empty_and_invalid(self):
+        assert list(TestUser.objects.all().parallel_iter(workers=2)) == []
+        assert TestUser.objects.all().map_partitions(count_rows, workers=2) == []
+        with pytest.raises(QueryException):
+            list(TestUser.objects.all().parallel_iter(partition_by="name"))
+        with pytest.raises(QueryException):
+            list(TestUser.objects.filter(id__gte=1).parallel_iter())
+
+
+class TestAsync:
+    def test_async_iteration_and_count(self, create_company, create_user):
+        user = create_user(name="Async", age=30)
+        create_user(bulk_create=4, age=10)
+        create_company(owner=user.id, company="Async Co")
+
+        async def run():
+            users = [i async for i in TestUser.objects.filter(age=10)]
+            companies = [i async for i in TestCompany.objects.select_related("owner")]
+            return users, companies, await TestUser.objects.filter(age=10).acount()
+
+        users, companies, count = asyncio.run(run())
+        assert len(users) == 4 and all(isinstance(i, TestUser) for i in users)
+        assert companies[0].owner.name == "Async"
+        assert count == 4
+
+    def test_asave(self):
+        async def run():
+            user = TestUser(name="New", username="async", sex="m", address="A", age=1)
+            await user.asave()
+            user.age = 2
+            await user.asave()
+            await user.asave()
+            return user
+
+        user = asyncio.run(run())
+        assert user.get_dirty_fields() == []
+        saved = TestUser.objects.get(id=user.id)
+        assert (saved.name, saved.age) == ("New", 2)
+
+    def test_abulk_create(self):
+        rows = [
+            dict(name="Bulk", username="bulk{}".format(i), sex="m", address="A", age=i)
+            for i in range(5)
+        ]
+
+        async def run():
+            count = await TestUser.objects.abulk_create(rows[:2])
+            pks = await TestUser.objects.abulk_create(
+                [TestUser(**i) for i in rows[2:]], batch_size=2, returning=True
+            )
+            return count, pks
+
+        count, pks = asyncio.run(run())
+        assert count == 2
+        assert sorted(pks) == sorted(
+            i.id
+            for i in TestUser.objects.filter(username__in=["bulk2", "bulk3", "bulk4"])
+        )
+        assert TestUser.objects.count() == 5
+
+    def test_abulk_create_rolls_back(self):
+        rows = [
+            dict(name="Ok", username="ok", sex="m", address="A", age=1),
+            dict(name="Broken", username="broken", sex="m", address="A"),
+        ]
+
+        async def run():
+            with pytest.raises(NotNullViolation):
+                await TestUser.objects.abulk_create(rows, batch_size=1)
+            return await TestUser.objects.acount()
+
+        assert asyncio.run(run()) == 0
+
+    def test_queries_run_concurrently(self):
+        async def sleep():
+            async with AsyncPostgreSQL() as pgsql:
+                await pgsql.query("SELECT pg_sleep(0.3);")
+
+        async def run():
+            await configure_async_pool(max_size=10)
+            started = time.monotonic()
+            await asyncio.gather(*[sleep() for _ in range(10)])
+            return time.monotonic() - started
+
+        assert asyncio.run(run()) < 1.5
+
+    def test_pool_timeout(self):
+        async def run():
+            pool = AsyncConnectionPool(max_size=1, timeout=0.1)
+            conn = await pool.getconn()
+            with pytest.raises(PoolTimeoutException):
+                await pool.getconn()
+            await pool.putconn(conn)
+            assert await pool.getconn() is conn
+            await pool.closeall()
+
+        asyncio.run(run())
+
+
+class TestQueryLogging:
+    def test_disabled_by_default(self, create_user, capsys):
+        assert querylog.query_logger is None
+        create_user(name="Quiet")
+        list(TestUser.objects.filter(name="Quiet"))
+        assert capsys.readouterr().out == ""
+
+    def test_structured_records(self, create_user, query_records):
+        create_user(name="Logged")
+        del query_records[:]
+        list(TestUser.objects.filter(name="Logged"))
+        (record,) = query_records
+        assert record.sql.startswith("SELECT") and "%s" in record.sql
+        assert (record.param_count, record.rows) == (1, 1)
+        assert record.duration > 0
+        assert not record.slow and record.error is None
+
+    def test_bulk_statements_log_templates(self, query_records):
+        rows = [
+            dict(name="Bulk", username="bulk{}".format(i), sex="m", address="A", age=i)
+            for i in range(3)
+        ]
+        TestUser.objects.bulk_create(rows, returning=True)
+        TestUser.objects.bulk_create(rows[:0])
+        assert "VALUES %s" in query_records[-1].sql
+        assert query_records[-1].param_count == 3
+        assert query_records[-1].rows == 3
+
+    def test_sampling_and_slow_queries(self, query_records):
+        querylog.configure_query_logging(
+            sample_rate=0, slow_query_threshold=0.05, handler=query_records.append
+        )
+        with PostgreSQL() as pgsql:
+            pgsql.query("SELECT 1;")
+            pgsql.query("SELECT pg_sleep(0.1);")
+        (record,) = query_records
+        assert record.slow and "pg_sleep" in record.sql
+
+    def test_errors_are_recorded(self, query_records):
+        with PostgreSQL() as pgsql:
+            with pytest.raises(psycopg2.errors.UndefinedTable):
+                pgsql.query("SELECT * FROM missing_table;")
+        assert isinstance(query_records[-1].error, psycopg2.errors.UndefinedTable)
+
+    def test_default_handler(self, caplog, query_records):
+        querylog.configure_query_logging(slow_query_threshold=0)
+        with caplog.at_level("WARNING", logger="orm.queries"):
+            with PostgreSQL() as pgsql:
+                pgsql.query("SELECT %s;", [1])
+        assert "SELECT %s;" in caplog.text
+        assert caplog.records[-1].query.param_count == 1
+
+    def test_async_records(self, query_records):
+        async def run():
+            await TestUser.objects.acount()
+
+        asyncio.run(run())
+        assert query_records[-1].sql.startswith("SELECT COUNT(*)")
+
+
+class TestInstrumentation:
+    def test_execute_hooks(self, create_user):
+        create_user(name="Hooked")
+        calls = []
+
+        def before(sql, params):
+            calls.append(("before", sql))
+
+        def after(sql, params, duration, rows, error):
+            calls.append(("after", sql, rows))
+
+        instrumentation.register_hook("before_execute", before)
+        instrumentation.register_hook("after_execute", after)
+        try:
+            list(TestUser.objects.filter(name="Hooked"))
+        finally:
+            instrumentation.unregister_hook("before_execute", before)
+            instrumentation.unregister_hook("after_execute", after)
+        assert [i[0] for i in calls] == ["before", "after"]
+        assert calls[0][1] == calls[1][1] and calls[1][2] == 1
+        assert not instrumentation.enabled
+        with pytest.raises(ValueError):
+            instrumentation.register_hook("on_commit", before)
+
+    def test_query_stats(self, create_user):
+        create_user(bulk_create=5)
+        with instrumentation.query_stats() as outer:
+            configure_pool(min_size=0, max_size=2)
+            with instrumentation.query_stats() as inner:
+                users = list(TestUser.objects.all())
+            TestUser.objects.count()
+        assert len(users) == 5
+        assert (inner.queries, inner.rows) == (1, 5)
+        assert inner.hydration_time > 0 and inner.db_time > 0
+        assert outer.queries == 2 and outer.connections_opened == 1
+        assert outer.as_dict()["rows"] == 6
+        assert not instrumentation.enabled
+
+    def test_iterator_stats(self, create_user):
+        create_user(bulk_create=5)
+        with instrumentation.query_stats() as stats:
+            users = list(TestUser.objects.all().iterator(chunk_size=2))
+            iterator = TestUser.objects.all().iterator(chunk_size=2)
+            next(iterator)
+            iterator.close()
+        assert len(users) == 5
+        # The closed iterator had read its first chunk of two rows.
+        assert (stats.queries, stats.rows) == (2, 7)
+        assert stats.db_time > 0
+
+    def test_assert_max_queries(self, create_company, create_user):
+        for i in range(3):
+            create_company(owner=create_user().id)
+        with pytest.raises(AssertionError, match="4 queries executed"):
+            with instrumentation.assert_max_queries(1):
+                [i.owner.name for i in TestCompany.objects.all()]
+        with instrumentation.assert_max_queries(1):
+            [i.owner.name for i in TestCompany.objects.select_related("owner")]
+
+    def test_async_stats(self, create_user):
+        create_user()
+
+        async def run():
+            with instrumentation.query_stats() as stats:
+                [i async for i in TestUser.objects.all()]
+            return stats
+
+        stats = asyncio.run(run())
+        assert (stats.queries, stats.rows) == (1, 1)
+        assert stats.connections_opened == 1 and stats.hydration_time > 0
+
+
+class TestResultCache:
+    def test_chaining_returns_clones(self, create_user):
+        create_user(name="Young", age=10)
+        create_user(name="Old", age=50)
+        users = TestUser.objects.all()
+        young = users.filter(age=10)
+        ordered = users.order_by("-age")
+        assert young is not users and ordered is not users
+        assert users.count() == 2
+        assert [i.name for i in young] == ["Young"]
+        assert [i.name for i in ordered] == ["Old", "Young"]
+        assert list(users.order_by("age").values_list("name", flat=True)) == [
+            "Young",
+            "Old",
+        ]
+        assert users.count() == 2
+
+    def test_evaluated_set_is_cached(self, create_user, captured_queries):
+        create_user(bulk_create=3)
+        users = TestUser.objects.all()
+        del captured_queries[:]
+        assert len(users) == 3
+        assert bool(users)
+        assert [i.id for i in users] == [i.id for i in users]
+        assert users[1].id == list(users)[1].id
+        assert [i.id for i in users[1:]] == [i.id for i in list(users)[1:]]
+        assert users.count() == 3 and users.exists()
+        assert len(captured_queries) == 1
+
+    def test_new_filter_is_not_stale(self, create_user):
+        create_user(name="A", age=10)
+        create_user(name="B", age=20)
+        users = TestUser.objects.all()
+        assert users.count() == 2
+        assert [i.name for i in users.filter(age=20)] == ["B"]
+        assert len(users) == 2
+
+    def test_unevaluated_index_and_slice_query(self, create_user, captured_queries):
+        create_user(bulk_create=4)
+        users = TestUser.objects.order_by("id")
+        del captured_queries[:]
+        assert users[2].id and users[1:3].count() == 2
+        assert len(captured_queries) == 2
+        assert "OFFSET" in captured_queries[0]
+
+    def test_empty_set(self):
+        users = TestUser.objects.filter(age=1000)
+        assert not users
+        assert len(users) == 0
+
+    def test_async_iteration_is_cached(self, create_user):
+        create_user(bulk_create=2)
+        users = TestUser.objects.all()
+
+        async def run():
+            with instrumentation.query_stats() as stats:
+                first = [i async for i in users]
+                second = [i async for i in users]
+            return first, second, stats
+
+        first, second, stats = asyncio.run(run())
+        assert first == second and stats.queries == 1
+        assert len(users) == 2
+
+
+class TestQueryResultCache:
+    def test_repeated_reads_hit_the_cache(
+        self, create_user, result_cache, captured_queries
+    ):
+        create_user(bulk_create=3)
+        del captured_queries[:]
+        first = list(TestUser.objects.order_by("id"))
+        second = list(TestUser.objects.order_by("id"))
+        assert [i.id for i in first] == [i.id for i in second]
+        assert first[0] is not second[0]
+        assert TestUser.objects.count() == TestUser.objects.count() == 3
+        assert TestUser.objects.filter(age__in=[-1, -2]).exists() is False
+        assert TestUser.objects.filter(age__in=[-1, -2]).exists() is False
+        assert len(captured_queries) == 3
+        assert result_cache.info()["hits"] == 3
+
+    def test_writes_invalidate(self, create_user, result_cache):
+        user = create_user(name="Before", age=30)
+        assert TestUser.objects.get(id=user.id).name == "Before"
+        user.name = "After"
+        user.save()
+        assert TestUser.objects.get(id=user.id).name == "After"
+        create_user(bulk_create=2)
+        assert TestUser.objects.count() == 3
+        user.age = 31
+        TestUser.objects.bulk_update([user], ["age"])
+        assert TestUser.objects.get(id=user.id).age == 31
+        user.delete()
+        assert TestUser.objects.count() == 2
+        TestUser.objects.filter(age__gte=0).delete()
+        assert not TestUser.objects.exists()
+
+    def test_joined_table_writes_invalidate(
+        self, create_user, create_company, result_cache
+    ):
+        owner = create_user(name="Owner")
+        create_company(owner=owner.id, bulk_create=1)
+        company = TestCompany.objects.get(owner=owner.id)
+        companies = TestCompany.objects.select_related("owner")
+        assert companies.get(id=company.id).owner.name == "Owner"
+        owner.name = "Renamed"
+        owner.save()
+        companies = TestCompany.objects.select_related("owner")
+        assert companies.get(id=company.id).owner.name == "Renamed"
+
+    def test_opt_in(self, create_user, result_cache, captured_queries, monkeypatch):
+        monkeypatch.setattr(TestUser._meta, "cache", False)
+        create_user()
+        del captured_queries[:]
+        assert TestUser.objects.count() == TestUser.objects.count()
+        assert len(captured_queries) == 2
+
+    def test_atomic_block_bypasses_cache(self, create_user, result_cache):
+        user = create_user(age=30)
+        assert TestUser.objects.get(id=user.id).age == 30
+        with atomic():
+            user.age = 31
+            user.save()
+            assert TestUser.objects.get(id=user.id).age == 31
+        assert TestUser.objects.get(id=user.id).age == 31
+        with pytest.raises(ValueError):
+            with atomic():
+                user.age = 32
+                user.save()
+                raise ValueError
+        assert TestUser.objects.get(id=user.id).age == 31
+
+    def test_memory_backend_bounds(self):
+        backend = cache.MemoryCacheBackend(maxsize=2, max_rows=3)
+        backend.set("a", [1])
+        backend.set("b", [1])
+        assert backend.get("a") == [1]
+        backend.set("c", [1])
+        assert backend.get("b") is None and backend.get("a") == [1]
+        backend.set("d", [1, 2, 3])
+        assert backend.info()["size"] == 1 and backend.info()["rows"] == 3
+        backend.set("e", [1, 2, 3, 4])
+        assert backend.get("e") is None and backend.get("d") == [1, 2, 3]
+
+    def test_memory_backend_ttl(self):
+        backend = cache.MemoryCacheBackend(ttl=0.01)
+        backend.set("a", [1])
+        assert backend.get("a") == [1]
+        time.sleep(0.02)
+        assert backend.get("a") is None
+        assert backend.info()["size"] == 0
+
+    def test_sqlite_backend(self, create_user, result_cache, monkeypatch, tmp_path):
+        path = str(tmp_path / "cache.sqlite3")
+        backend = cache.SQLiteCacheBackend(path, maxsize=2)
+        monkeypatch.setattr(cache, "backend", backend)
+        user = create_user(age=30)
+        assert TestUser.objects.get(id=user.id).age == 30
+        other = cache.SQLiteCacheBackend(path)
+        version = other.get_version(TestUser.get_full_table_name())
+        user.age = 31
+        user.save()
+        assert other.get_version(TestUser.get_full_table_name()) == version + 1
+        assert TestUser.objects.get(id=user.id).age == 31
+        for key in "abc":
+            backend.set(key, [key])
+        assert backend.get("a") is None and other.get("c") == ["c"]
+
+    def test_incomplete_backend(self):
+        class Backend(cache.CacheBackend):
+            def get(self, key):
+                return None
+
+        with pytest.raises(TypeError, match="bump_version"):
+            Backend()
+
+
+class TestIdentityMap:
+    def test_one_instance_per_row(self, create_user, create_company):
+        owner = create_user()
+        create_company(owner=owner.id, bulk_create=2)
+        with identity_map():
+            user = TestUser.objects.get(id=owner.id)
+            assert next(iter(TestUser.objects.filter(age=owner.age))) is user
+            lazy = list(TestCompany.objects.order_by("id"))
+            assert all(i.owner.get_related_object() is user for i in lazy)
+            joined = list(TestCompany.objects.select_related("owner").order_by("id"))
+            assert joined == lazy
+        with identity_map():
+            user = TestUser.objects.get(id=owner.id)
+            joined = list(TestCompany.objects.select_related("owner"))
+            assert all(i.owner is user for i in joined)
+        assert TestUser.objects.get(id=owner.id) is not user
+
+    def test_get_by_pk_skips_query(self, create_user, captured_queries):
+        created = create_user()
+        with identity_map():
+            user = TestUser.objects.get(pk=created.id)
+            del captured_queries[:]
+            assert TestUser.objects.get(pk=user.id) is user
+            assert TestUser.objects.get(id=user) is user
+            assert TestUser.objects.filter(age=user.age).get(id=user.id) is user
+            assert len(captured_queries) == 1
+
+    def test_loaded_instance_is_not_rehydrated(self, create_user):
+        created = create_user(name="Loaded")
+        with identity_map():
+            user = TestUser.objects.get(id=created.id)
+            user.name = "Unsaved"
+            assert [i.name for i in TestUser.objects.all()] == ["Unsaved"]
+            user.refresh_from_db()
+            assert user.name == "Loaded"
+            assert TestUser.objects.get(id=created.id) is user
+
+    def test_writes_update_the_map(self, create_user):
+        with identity_map() as objects:
+            user = create_user()
+            other = create_user()
+            assert user in objects and TestUser.objects.get(pk=user.id) is user
+            user.delete()
+            with pytest.raises(ObjectDoesNotExist):
+                TestUser.objects.get(pk=user.id)
+            assert other in objects
+            TestUser.objects.all().delete()
+            assert len(objects) == 0
+
+    def test_rolled_back_inserts_leave_the_map(self, create_user):
+        kept = create_user()
+        with identity_map() as objects:
+            with pytest.raises(ValueError):
+                with atomic():
+                    user = create_user()
+                    TestUser.objects.get(pk=kept.id)
+                    raise ValueError
+            assert user not in objects and len(objects) == 0
+            with pytest.raises(ObjectDoesNotExist):
+                TestUser.objects.get(pk=user.id)
+            with atomic():
+                outer = create_user()
+                with pytest.raises(ValueError):
+                    with atomic():
+                        inner = create_user()
+                        raise ValueError
+            assert outer in objects and inner not in objects
+            assert TestUser.objects.get(pk=outer.id) is outer
+            with pytest.raises(ObjectDoesNotExist):
+                TestUser.objects.get(pk=inner.id)
+
+    def test_scoped_to_context(self, create_user):
+        created = create_user()
+        seen = []
+        with identity_map() as objects:
+            with identity_map() as nested:
+                assert nested is objects
+            TestUser.objects.get(id=created.id)
+            thread = threading.Thread(target=lambda: seen.append(get_identity_map()))
+            thread.start()
+            thread.join()
+        assert seen == [None] and get_identity_map() is None
+
+
+class TestDeferredColumns:
+    def test_only_selects_listed_columns(self, create_user, captured_queries):
+        create_user(name="Only", age=30)
+        del captured_queries[:]
+        user = TestUser.objects.only("name").get(name="Only")
+        assert '"address"' not in captured_queries[0]
+        assert "table_0.address" not in captured_queries[0]
+        assert "table_0.name" in captured_queries[0]
+        assert "table_0.id" in captured_queries[0]
+        assert user.name == "Only" and user.age == 30
+
+    def test_deferred_columns_load_in_one_query(self, create_user):
+        create_user(bulk_create=5)
+        users = list(TestUser.objects.defer("address", "sex").order_by("id"))
+        expected = list(TestUser.objects.order_by("id").values_list("address", "sex"))
+        with instrumentation.assert_max_queries(1):
+            assert [(i.address, i.sex) for i in users] == expected
+
+    def test_related_paths(self, create_user, create_company, captured_queries):
+        owner = create_user(name="Owner", address="Lagos")
+        create_company(owner=owner.id, bulk_create=2)
+        del captured_queries[:]
+        companies = list(TestCompany.objects.only("name", "owner__name"))
+        sql = captured_queries[0]
+        assert "JOIN" in sql and "table_1.address" not in sql
+        assert "table_0.owner" in sql and "table_0.catch_phrase" not in sql
+        assert [i.owner.name for i in companies] == ["Owner", "Owner"]
+        assert len(captured_queries) == 1
+        assert companies[0].owner.address == "Lagos"
+        assert companies[1].owner.address == "Lagos"
+        assert len(captured_queries) == 2
+        companies = list(TestCompany.objects.defer("owner__address"))
+        assert companies[0].owner.name == "Owner"
+        assert companies[0].owner.address == "Lagos"
+
+    def test_save_after_defer(self, create_user):
+        created = create_user(name="Before", age=30)
+        user = TestUser.objects.defer("name", "age").get(id=created.id)
+        user.name = "After"
+        assert user.get_dirty_fields() == ["name"]
+        user.save()
+        assert user.get_dirty_fields() == []
+        assert user.age == 30 and user.get_dirty_fields() == []
+        refreshed = TestUser.objects.get(id=created.id)
+        assert (refreshed.name, refreshed.age) == ("After", 30)
+
+    def test_compact_rows(self, create_user):
+        created = create_user(name="Compact", age=30)
+        row = TestUser.compact_class().objects.only("age").get(id=created.id)
+        assert row.age == 30 and row.name == "Compact"
+        with pytest.raises(AttributeError):
+            row.missing
+
+    def test_invalid_columns(self):
+        with pytest.raises(QueryException):
+            TestUser.objects.only("missing")
+        with pytest.raises(QueryException):
+            TestCompany.objects.defer("owner__missing")
+        with pytest.raises(QueryException):
+            TestCompany.objects.defer("missing__name")
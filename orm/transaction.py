@@ -0,0 +1,124 @@
+import contextvars
+import itertools
+from contextlib import ContextDecorator
+
+from . import cache, identity
+from .postgres import (
+    PostgreSQL,
+    bind_connection,
+    get_bound_connection,
+    unbind_connection,
+)
+
+_savepoint_names = itertools.count(1)
+# Save state of instances written inside the innermost block, restored if it rolls back.
+_saved_instances = contextvars.ContextVar("saved_instances", default=None)
+
+
+class TransactionException(Exception):
+    pass
+
+
+class Atomic(ContextDecorator):
+    """
+    Runs the block in one transaction on a connection bound to the current
+    thread or task. Nested blocks run in savepoints.
+    """
+
+    def __init__(self, savepoint=True):
+        self.savepoint = savepoint
+        self._pgsql = None
+        self._token = None
+        self._cache_token = None
+        self._identity_token = None
+        self._saved_token = None
+        self._savepoint_name = None
+
+    def _recreate_cm(self):
+        return self.__class__(savepoint=self.savepoint)
+
+    def __enter__(self):
+        if self._pgsql is not None or self._savepoint_name is not None:
+            raise TransactionException("Atomic block is already active.")
+        conn = get_bound_connection()
+        if conn is None:
+            self._pgsql = PostgreSQL()
+            self._token = bind_connection(self._pgsql.connection)
+            self._cache_token = cache.defer_invalidations()
+        elif self.savepoint:
+            self._savepoint_name = "orm_savepoint_{}".format(next(_savepoint_names))
+            with conn.cursor() as cursor:
+                cursor.execute("SAVEPOINT {};".format(self._savepoint_name))
+        if self._pgsql is not None or self._savepoint_name is not None:
+            self._identity_token = identity.track_additions()
+            self._saved_token = _saved_instances.set([])
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        rolled_back = exc_type is not None
+        if self._pgsql is not None:
+            pgsql, self._pgsql = self._pgsql, None
+            try:
+                if exc_type is None:
+                    try:
+                        pgsql.connection.commit()
+                    except BaseException:
+                        rolled_back = True
+                        raise
+                else:
+                    pgsql.connection.rollback()
+            finally:
+                self.__end_tracking(rolled_back)
+                unbind_connection(self._token)
+                self._token = None
+                pgsql.close()
+                # Results cached while the block ran may predate its commit.
+                cache.flush_invalidations(self._cache_token)
+                self._cache_token = None
+        elif self._savepoint_name is not None:
+            name, self._savepoint_name = self._savepoint_name, None
+            try:
+                with get_bound_connection().cursor() as cursor:
+                    if exc_type is not None:
+                        cursor.execute("ROLLBACK TO SAVEPOINT {};".format(name))
+                    cursor.execute("RELEASE SAVEPOINT {};".format(name))
+            finally:
+                self.__end_tracking(rolled_back)
+        return False
+
+    def __end_tracking(self, rolled_back):
+        token, self._identity_token = self._identity_token, None
+        if token is not None:
+            identity.end_tracking(token, rolled_back)
+        token, self._saved_token = self._saved_token, None
+        if token is not None:
+            saved = _saved_instances.get()
+            _saved_instances.reset(token)
+            if rolled_back:
+                for obj, loaded_values, pk_name in reversed(saved):
+                    obj._loaded_values = loaded_values
+                    if pk_name is not None:
+                        setattr(obj, pk_name, None)
+            elif _saved_instances.get() is not None:
+                _saved_instances.get().extend(saved)
+
+
+def atomic(func=None, savepoint=True):
+    if callable(func):
+        return Atomic(savepoint=savepoint)(func)
+    return Atomic(savepoint=savepoint)
+
+
+def in_atomic_block():
+    return get_bound_connection() is not None
+
+
+def record_saved(obj, inserted=False):
+    """
+    Remembers the save state of `obj` before a write inside a transaction
+    block, so that a rollback leaves it unsaved again.
+    """
+    saved = _saved_instances.get()
+    if saved is not None:
+        pk_name = obj._meta.pk_name if inserted else None
+        saved.append((obj, obj._loaded_values, pk_name))